@@ -0,0 +1,186 @@
+import argparse, csv, json, multiprocessing, os, random, statistics, time
+
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1") # one per worker otherwise
+
+import pygame
+
+from main import BrewingWindow, TeaLeaf, actions, factions, terrains
+from headless import HeadlessGame, random_actions
+from pathing import DELTAS, distance_field, downhill
+
+# one row per game, in this order
+FIELDS = ["seed", "policy", "turns", "depth", "alive", "teas_brewed", "damage_dealt", "damage_taken", "kills", "seconds"]
+# what gets averaged at the end
+TOTALS = ["turns", "depth", "teas_brewed", "damage_dealt", "damage_taken", "kills"]
+
+
+class RandomBot:
+    # the same flailing headless.py does
+    def __init__(self, rng):
+        self.actions = random_actions(rng)
+
+    def act(self, game):
+        return next(self.actions)
+
+    def on_modal(self, window):
+        pass
+
+
+class BrewerBot:
+    """
+    Plays it straight: hits whatever's next to it, brews whatever leaves it has whenever it's on the
+    stairs with a few (first level: the kettle it starts beside), then goes down. Walks by distance
+    fields, so it never gets lost, but doesn't go out of its way for leaves either.
+    """
+    BREW_AT = 3 # leaves of one kind worth stopping for
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.fields = {} # goal -> distance field, for the current level
+        self.level = None
+
+    def act(self, game):
+        pl, level = game.player, game.level
+        if level is not self.level:
+            self.level, self.fields = level, {}
+        pos = (pl.x, pl.y)
+
+        for d, (dx, dy) in enumerate(DELTAS):
+            # a goblin can start out stuck in a wall, where nobody can hit it
+            i = (pl.y + dy) * level.ncols + pl.x + dx
+            if level.valid_coords([pl.x + dx, pl.y + dy]) and level.passable[i]:
+                unit = level.unit_grid[i]
+                if unit and unit.faction != factions.PLAYER:
+                    return actions.tile_move_actions[d]
+
+        kettle = game.active_kettle
+        if kettle in pl.inventory:
+            if pl.tile.name != "stairs":
+                return self.walk_to(level, self.stairs(level), pos)
+            if self.leaves_to_brew(pl) >= self.BREW_AT:
+                # then steps off it next time round, and bumps it from there
+                return actions.DROP_KETTLE
+            return actions.DESCEND
+        if kettle.tile is None:
+            return actions.WAIT # out of reach for good. nothing to do but wait for the turns to run out
+        if pos == (kettle.tile.x, kettle.tile.y):
+            return self.step_off(level, pos)
+        if kettle.timer:
+            return actions.WAIT if max(abs(kettle.tile.x - pl.x), abs(kettle.tile.y - pl.y)) <= 1 else \
+                self.walk_to(level, (kettle.tile.x, kettle.tile.y), pos)
+        if not kettle.teas and not self.leaves_to_brew(pl):
+            return actions.WAIT # can't get it back without brewing something first
+        # bumping it either opens the brewing window (see on_modal) or hands back the teas and the kettle
+        return self.walk_to(level, (kettle.tile.x, kettle.tile.y), pos)
+
+    def on_modal(self, window):
+        if isinstance(window, BrewingWindow):
+            satchel = window.parent.player.inventory
+            variety = max(range(4), key=lambda v: satchel.count(TeaLeaf, v))
+            for _ in range(satchel.count(TeaLeaf, variety)):
+                window.handle(pygame.event.Event(pygame.TEXTINPUT, {"text": "abcd"[variety]}))
+
+    def leaves_to_brew(self, pl):
+        return max(pl.inventory.count(TeaLeaf, v) for v in range(4))
+
+    def stairs(self, level):
+        i = level.terrain.index(terrains.STAIRS)
+        return i % level.ncols, i // level.ncols
+
+    def walk_to(self, level, goal, pos):
+        field = self.fields.get(goal)
+        if field is None:
+            field = self.fields[goal] = distance_field(level.passable, level.ncols, level.nrows, goal, level.ncols * level.nrows)
+        d = downhill(field, level.ncols, level.nrows, pos, lambda i: level.unit_grid[i] is not None)
+        return actions.tile_move_actions[d] if d is not None else self.rng.choice(actions.tile_move_actions)
+
+    def step_off(self, level, pos):
+        x, y = pos
+        free = [d for d, (dx, dy) in enumerate(DELTAS) if level.valid_coords([x + dx, y + dy])
+                and level.passable[(y + dy) * level.ncols + x + dx] and level.unit_grid[(y + dy) * level.ncols + x + dx] is None]
+        return actions.tile_move_actions[self.rng.choice(free)] if free else actions.WAIT
+
+
+POLICIES = {"random": RandomBot, "brewer": BrewerBot}
+
+
+def play(job):
+    # one whole game, in whichever worker process picked it up. everything it draws from comes off the seed
+    seed, policy, max_turns, size = job
+    start = time.perf_counter()
+    bot = POLICIES[policy](random.Random(f"{seed}/policy"))
+    sim = HeadlessGame(seed=seed, size=size, on_modal=bot.on_modal)
+    game = sim.game
+    # actions that don't take a turn (bumping the kettle, walking into a wall) still count here, so a stuck bot stops
+    steps = 0
+    while game.player.living and game.turns < max_turns and steps < 4 * max_turns:
+        sim.step(bot.act(game))
+        steps += 1
+    row = {"seed": seed, "policy": policy, "turns": game.turns, "depth": game.level.level_num,
+           "alive": int(game.player.living), "seconds": round(time.perf_counter() - start, 4), **game.stats}
+    return {field: row[field] for field in FIELDS}
+
+
+def parse_seeds(text):
+    # "0-999", "3,7,12" or a mix
+    seeds = []
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        seeds.extend(range(int(first), int(last) + 1) if last else [int(first)])
+    return seeds
+
+
+def run_batch(seeds, policy, max_turns, size=None, workers=None):
+    # yields rows as games finish, which isn't seed order once there's more than one worker
+    jobs = [(seed, policy, max_turns, size) for seed in seeds]
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        yield from map(play, jobs)
+        return
+    # a few chunks per worker keeps them all busy to the end without a round trip per game
+    chunksize = max(1, len(jobs) // (workers * 8))
+    with multiprocessing.Pool(workers) as pool:
+        yield from pool.imap_unordered(play, jobs, chunksize)
+
+
+def summarize(rows):
+    lines = [f"{len(rows)} games, {sum(r['alive'] for r in rows)} survived"]
+    for field in TOTALS:
+        values = [r[field] for r in rows]
+        lines.append(f"{field:>13} mean {statistics.mean(values):9.2f}  median {statistics.median(values):7.1f}  max {max(values)}")
+    return lines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play many seeded games with a bot across all cores and tally how they went.")
+    parser.add_argument("--seeds", default="0-99", help="e.g. 0-999 or 1,5,9")
+    parser.add_argument("--policy", choices=list(POLICIES), default="brewer")
+    parser.add_argument("--turns", type=int, default=2000, help="most turns to play each game for")
+    parser.add_argument("--workers", type=int, help="processes to use; all the cores by default")
+    parser.add_argument("--size", help="COLSxROWS of the caves")
+    parser.add_argument("--out", help="write each game's row here as it finishes; .jsonl for json lines, csv otherwise")
+    args = parser.parse_args()
+
+    seeds = parse_seeds(args.seeds)
+    size = [int(n) for n in args.size.lower().split("x")] if args.size else None
+    out = open(args.out, "w", newline="") if args.out else None
+    writer = None
+    if out and not args.out.endswith(".jsonl"):
+        writer = csv.DictWriter(out, FIELDS)
+        writer.writeheader()
+
+    rows = []
+    start = time.perf_counter()
+    for row in run_batch(seeds, args.policy, args.turns, size, args.workers):
+        rows.append(row)
+        if writer:
+            writer.writerow(row)
+        elif out:
+            out.write(json.dumps(row) + "\n")
+    elapsed = time.perf_counter() - start
+    if out:
+        out.close()
+
+    for line in summarize(rows):
+        print(line)
+    print(f"in {elapsed:.2f}s ({len(rows) / elapsed:.1f} games/s, {sum(r['turns'] for r in rows) / elapsed:.0f} turns/s)")
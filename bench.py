@@ -0,0 +1,216 @@
+import argparse, json, platform, random, subprocess, sys, time, tracemalloc
+
+import pygame
+
+import main
+from main import Level, Unit, GameRoot, Kettle, TeaLeaf, InventoryWindow, BrewingWindow, TeaDeckWindow, \
+    factions, tea_varieties, seed_rngs, FLOOR_FRACTION
+from bres import bresenham
+
+
+OPS = ["generate", "bresenham", "los_clear", "los_clear_many", "fov", "render", "advance",
+       "inventory_window", "brewing_window", "tea_deck_window"]
+
+
+def make_game(cols, rows, monsters, seed):
+    # a level like new_game() builds, but at any size and with as many goblins as asked for
+    seed_rngs(seed)
+    rng = random.Random(seed)
+    lev = Level(cols, rows, 1)
+    start = lev.generate(int(cols * rows * FLOOR_FRACTION))
+    # the player shouldn't die halfway through a benchmark
+    player = Unit("questant", "Tom", 10**9, 10**9, 4, "@", *start, lev)
+    floors = [c for c in lev.passable_coords() if c != start]
+    for pos in rng.sample(floors, min(monsters, len(floors))):
+        Unit("goblin", "", 5, 5, 3, "g", *pos, lev, factions.CAVE)
+    for variety in [tea_varieties.BLACK, tea_varieties.GREEN, tea_varieties.HERBAL] * 3:
+        player.add_item(TeaLeaf(variety))
+    game = GameRoot(lev, player, pregenerate=False)
+    kettle = Kettle(game)
+    game.set_kettle(kettle)
+    return game
+
+
+def time_op(op, iterations):
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter_ns()
+        op(i)
+        samples.append(time.perf_counter_ns() - start)
+    return samples
+
+
+def alloc_op(op, iterations):
+    # run separately from timing since tracemalloc slows everything down
+    tracemalloc.start()
+    peaks = []
+    for i in range(iterations):
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        op(i)
+        _, peak = tracemalloc.get_traced_memory()
+        peaks.append(peak - base)
+    tracemalloc.stop()
+    return peaks
+
+
+def footprint(cols, rows, monsters, seed):
+    # bytes a layer holds onto once it's built: terrain, leaves, goblins and the player's memory of it.
+    # tiles are views made on demand, so they're counted separately as what viewing every cell at once costs
+    tracemalloc.start()
+    base, _ = tracemalloc.get_traced_memory()
+    game = make_game(cols, rows, monsters, seed)
+    level_bytes = tracemalloc.get_traced_memory()[0] - base
+    base = tracemalloc.get_traced_memory()[0]
+    tiles = game.level.all_tiles()
+    tile_bytes = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    return {"cols": cols, "rows": rows, "monsters": monsters, "items": len(game.level.item_grid),
+            "level_bytes": level_bytes, "tile_bytes": tile_bytes}
+
+
+def percentile(ordered, p):
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def summarize(samples, peaks):
+    ordered = sorted(samples)
+    return {"iterations": len(samples),
+            "mean_us": sum(samples) / len(samples) / 1000,
+            "p50_us": percentile(ordered, 50) / 1000,
+            "p90_us": percentile(ordered, 90) / 1000,
+            "p99_us": percentile(ordered, 99) / 1000,
+            "max_us": ordered[-1] / 1000,
+            "peak_alloc_bytes": max(peaks) if peaks else 0}
+
+
+def cases(cols, rows, monsters, seed, iterations):
+    # each case is name -> op(i), all built off the same seeded game
+    game = make_game(cols, rows, monsters, seed)
+    lev, player = game.level, game.player
+    main.load_fonts()
+    surf = pygame.Surface([main.WIDTH, main.HEIGHT])
+    game.camera = game.follow_player()
+    # modals size themselves off the screen
+    if main.screen is None:
+        main.screen = pygame.Surface([main.WIDTH, main.HEIGHT])
+
+    floors = lev.passable_coords()
+    rng = random.Random(seed)
+    pairs = []
+    for i in range(iterations):
+        a = rng.choice(floors)
+        b = [min(max(a[0] + rng.randint(-8, 8), 0), cols - 1), min(max(a[1] + rng.randint(-8, 8), 0), rows - 1)]
+        pairs.append((a, b))
+    # the same spread of targets around whichever spot los_clear_many looks from
+    offsets = [(b[0] - a[0], b[1] - a[1]) for a, b in pairs]
+
+    def los_clear_many(i):
+        x, y = pairs[i % len(pairs)][0]
+        lev.los_clear_many((x, y), [(x + dx, y + dy) for dx, dy in offsets])
+
+    def generate(i):
+        Level(cols, rows, 1).generate(int(cols * rows * FLOOR_FRACTION))
+
+    def fov(i):
+        lev.fov_key = None
+        lev.visible_coords(player)
+
+    def render(i):
+        # what's on screen around the player, which is all a frame ever draws
+        lev.render(surf, None, game.view())
+
+    def advance(i):
+        game.advance()
+
+    return {"generate": generate,
+            "bresenham": lambda i: bresenham(*pairs[i % len(pairs)]),
+            "los_clear": lambda i: lev.los_clear(*pairs[i % len(pairs)]),
+            "los_clear_many": los_clear_many,
+            "fov": fov,
+            "render": render,
+            "advance": advance,
+            "inventory_window": lambda i: InventoryWindow(game).rendered(),
+            "brewing_window": lambda i: BrewingWindow(game, game.active_kettle).rendered(),
+            "tea_deck_window": lambda i: TeaDeckWindow(game, [], False).rendered()}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=sys.path[0] or None).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def run(sizes, monster_counts, seed=0, iterations=100, only=None):
+    results = []
+    for cols, rows in sizes:
+        for monsters in monster_counts:
+            for name in OPS:
+                if only and name not in only:
+                    continue
+                # fresh game per op so one op's state (advance moving goblins, say) doesn't leak into the next
+                op = cases(cols, rows, monsters, seed, iterations)[name]
+                samples = time_op(op, iterations)
+                peaks = alloc_op(op, max(1, iterations // 10))
+                result = {"op": name, "cols": cols, "rows": rows, "monsters": monsters}
+                result.update(summarize(samples, peaks))
+                results.append(result)
+                print(f"{name:>16} {cols}x{rows} {monsters:>4} monsters  "
+                      f"p50 {result['p50_us']:10.1f}us  p99 {result['p99_us']:10.1f}us  "
+                      f"peak alloc {result['peak_alloc_bytes']:>9}B")
+    footprints = []
+    if not only or "footprint" in only:
+        for cols, rows in sizes:
+            for monsters in monster_counts:
+                result = footprint(cols, rows, monsters, seed)
+                footprints.append(result)
+                print(f"{'footprint':>16} {cols}x{rows} {monsters:>4} monsters  {result['items']:>6} items  "
+                      f"level {result['level_bytes'] / 1024:10.1f}KiB  every tile {result['tile_bytes'] / 1024:10.1f}KiB")
+    return {"commit": git_commit(), "python": platform.python_version(), "pygame": pygame.version.ver,
+            "seed": seed, "iterations": iterations, "results": results, "footprints": footprints}
+
+
+def compare(old, new):
+    key = lambda r: (r["op"], r["cols"], r["rows"], r["monsters"])
+    before = {key(r): r for r in old["results"]}
+    print(f"p50 change from {old.get('commit')} to {new.get('commit')}:")
+    for r in new["results"]:
+        if key(r) in before and before[key(r)]["p50_us"]:
+            ratio = r["p50_us"] / before[key(r)]["p50_us"]
+            print(f"{r['op']:>16} {r['cols']}x{r['rows']} {r['monsters']:>4} monsters  {ratio:6.2f}x")
+    key = lambda r: (r["cols"], r["rows"], r["monsters"])
+    before = {key(r): r for r in old.get("footprints", [])}
+    for r in new.get("footprints", []):
+        if key(r) in before:
+            print(f"{'footprint':>16} {r['cols']}x{r['rows']} {r['monsters']:>4} monsters  "
+                  f"level {r['level_bytes'] / before[key(r)]['level_bytes']:6.2f}x  "
+                  f"every tile {r['tile_bytes'] / before[key(r)]['tile_bytes']:6.2f}x")
+
+
+def parse_size(text):
+    cols, rows = text.lower().split("x")
+    return int(cols), int(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time TeaRL's hot paths under a fixed seed.")
+    parser.add_argument("--sizes", default="72x20,200x60", help="comma separated COLSxROWS map sizes")
+    parser.add_argument("--monsters", default="1,50", help="comma separated monster counts")
+    parser.add_argument("--iterations", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", default="", help="comma separated op names to run (footprint for the memory one)")
+    parser.add_argument("--out", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="JSON results from an earlier run to compare against")
+    args = parser.parse_args()
+
+    report = run([parse_size(s) for s in args.sizes.split(",")],
+                 [int(m) for m in args.monsters.split(",")],
+                 args.seed, args.iterations, [o for o in args.only.split(",") if o])
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
@@ -45,4 +45,17 @@ def bresenham(start, end):
     # Reverse the list if the coordinates were swapped
     if swapped:
         points.reverse()
-    return points
\ No newline at end of file
+    return points
+
+# lines only depend on the difference between their ends, so the cells strictly between them can be worked
+# out once per (dx, dy) and slid to wherever the line starts. covers anything a unit can see or throw to
+RAY_TABLE_RANGE = 16
+RAY_TABLE = {(dx, dy): tuple(bresenham((0, 0), (dx, dy))[1:-1])
+             for dx in range(-RAY_TABLE_RANGE, RAY_TABLE_RANGE + 1)
+             for dy in range(-RAY_TABLE_RANGE, RAY_TABLE_RANGE + 1)}
+
+
+def ray_offsets(dx, dy):
+    # offsets of the cells between (0, 0) and (dx, dy), leaving out both ends
+    ray = RAY_TABLE.get((dx, dy))
+    return ray if ray is not None else tuple(bresenham((0, 0), (dx, dy))[1:-1])
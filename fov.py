@@ -0,0 +1,63 @@
+# octant transforms: each column is (xx, xy, yx, yy) for one of the eight octants
+MULTIPLIERS = [[1, 0, 0, -1, -1, 0, 0, 1],
+               [0, 1, -1, 0, 0, -1, 1, 0],
+               [0, 1, 1, 0, 0, -1, -1, 0],
+               [1, 0, 0, 1, -1, 0, 0, -1]]
+
+
+def field_of_view(origin, radius, blocks_light, in_bounds):
+    """
+    Recursive shadowcasting, adapted from
+    https://www.roguebasin.com/index.php/Python_shadowcasting_implementation
+    Returns the set of (x, y) coords visible from origin within radius.
+    Walls are visible, they just stop the light behind them.
+    """
+    ox, oy = origin
+    visible = {(ox, oy)}
+    for octant in range(8):
+        _cast_light(ox, oy, 1, 1.0, 0.0, radius,
+                    MULTIPLIERS[0][octant], MULTIPLIERS[1][octant],
+                    MULTIPLIERS[2][octant], MULTIPLIERS[3][octant],
+                    blocks_light, in_bounds, visible)
+    return visible
+
+
+def _cast_light(cx, cy, row, start, end, radius, xx, xy, yx, yy, blocks_light, in_bounds, visible):
+    if start < end:
+        return
+    radius_squared = radius * radius
+    new_start = start
+    for j in range(row, radius + 1):
+        dx, dy = -j - 1, -j
+        blocked = False
+        while dx <= 0:
+            dx += 1
+            # translate the dx, dy coordinates into map coordinates
+            x, y = cx + dx * xx + dy * xy, cy + dx * yx + dy * yy
+            # l_slope and r_slope store the slopes of the left and right extremities of the square
+            l_slope, r_slope = (dx - 0.5) / (dy + 0.5), (dx + 0.5) / (dy - 0.5)
+            if start < r_slope:
+                continue
+            elif end > l_slope:
+                break
+            # off the map counts as solid rock
+            opaque = not in_bounds(x, y) or blocks_light(x, y)
+            if dx * dx + dy * dy <= radius_squared and in_bounds(x, y):
+                visible.add((x, y))
+            if blocked:
+                # we're scanning a row of blocked squares
+                if opaque:
+                    new_start = r_slope
+                    continue
+                else:
+                    blocked = False
+                    start = new_start
+            elif opaque and j < radius:
+                # this is a blocking square, start a child scan
+                blocked = True
+                _cast_light(cx, cy, j + 1, start, l_slope, radius, xx, xy, yx, yy,
+                            blocks_light, in_bounds, visible)
+                new_start = r_slope
+        # row is scanned; do next row unless last square was blocked
+        if blocked:
+            break
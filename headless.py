@@ -0,0 +1,61 @@
+import argparse, random, time
+
+from main import new_game, seed_rngs, actions
+from profiler import profiler
+
+
+class HeadlessGame:
+    # runs the turn logic with no window, no event loop and no rendering.
+    # actions are the ones in main.actions, fed in by a script or a bot
+    def __init__(self, game=None, seed=None, size=None, on_modal=None):
+        # on_modal(window) gets a look at any window the action opened before it's shut, so a bot can fill a kettle
+        self.on_modal = on_modal
+        if seed is not None:
+            seed_rngs(seed)
+        self.game = game if game else new_game(*size) if size else new_game()
+
+    def step(self, action):
+        game = self.game
+        acted = game.do_action(action)
+        # nobody is around to press a key, so unless a bot wants to, no one fills the kettle either
+        while game.messages:
+            game.pop_message()
+        if game.active_modal and self.on_modal:
+            self.on_modal(game.active_modal)
+        while game.active_modal:
+            game.active_modal.close()
+        return acted
+
+    def run(self, action_stream, max_turns=None):
+        for action in action_stream:
+            if not self.game.player.living:
+                break
+            if max_turns is not None and self.game.turns >= max_turns:
+                break
+            self.step(action)
+        return self.game
+
+
+def random_actions(rng=random):
+    choices = actions.tile_move_actions + [actions.WAIT, actions.DESCEND]
+    while True:
+        yield rng.choice(choices)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run TeaRL turns as fast as possible, without a window.")
+    parser.add_argument("--turns", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace", help="write a chrome://tracing file of the turns here")
+    parser.add_argument("--size", help="COLSxROWS of the caves")
+    args = parser.parse_args()
+    profiler.enabled = bool(args.trace)
+
+    sim = HeadlessGame(seed=args.seed, size=[int(n) for n in args.size.lower().split("x")] if args.size else None)
+    start = time.perf_counter()
+    game = sim.run(random_actions(random.Random(args.seed)), max_turns=args.turns)
+    elapsed = time.perf_counter() - start
+    print(f"{game.turns} turns in {elapsed:.3f}s ({game.turns / elapsed:.0f} turns/s), "
+          f"player {'alive' if game.player.living else 'dead'} on cave layer {game.level.level_num}")
+    if args.trace:
+        profiler.dump_trace(args.trace)
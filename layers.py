@@ -0,0 +1,77 @@
+import os, tempfile
+from collections import OrderedDict
+
+
+class LayerStore:
+    """
+    Frozen cave layers (whatever savegame.freeze_level packed them into) by level number. Up to budget
+    bytes of them stay in memory; past that the least recently used go out to files, and come back
+    when they're asked for.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        self.in_memory = OrderedDict() # level_num -> bytes, least recently used first
+        self.on_disk = {} # level_num -> path
+        self.size = 0
+        self.directory = None # made the first time something gets evicted
+
+    def put(self, level_num, data):
+        self.discard(level_num)
+        self.in_memory[level_num] = data
+        self.size += len(data)
+        self.evict()
+
+    def get(self, level_num):
+        # the frozen layer, or None. counts as a use, so it's the last to go
+        if level_num in self.on_disk:
+            with open(self.on_disk[level_num], "rb") as f:
+                data = f.read()
+            self.put(level_num, data)
+        data = self.in_memory.get(level_num)
+        if data is not None:
+            self.in_memory.move_to_end(level_num)
+        return data
+
+    def peek(self, level_num):
+        # the frozen layer, or None, without it counting as a use: nothing comes back into memory
+        # and nothing else gets pushed out, so saving the game doesn't shuffle the store
+        if level_num in self.in_memory:
+            return self.in_memory[level_num]
+        if level_num in self.on_disk:
+            with open(self.on_disk[level_num], "rb") as f:
+                return f.read()
+        return None
+
+    def pop(self, level_num):
+        data = self.get(level_num)
+        self.discard(level_num)
+        return data
+
+    def discard(self, level_num):
+        if level_num in self.in_memory:
+            self.size -= len(self.in_memory.pop(level_num))
+        path = self.on_disk.pop(level_num, None)
+        if path:
+            os.remove(path)
+
+    def evict(self):
+        # always keeps the newest one in memory, however big it is
+        while self.size > self.budget and len(self.in_memory) > 1:
+            level_num, data = self.in_memory.popitem(last=False)
+            self.size -= len(data)
+            if self.directory is None:
+                # cleaned up along with the store
+                self.directory = tempfile.TemporaryDirectory(prefix="tearl-layers-")
+            path = os.path.join(self.directory.name, f"{level_num}.layer")
+            with open(path, "wb") as f:
+                f.write(data)
+            self.on_disk[level_num] = path
+
+    def __contains__(self, level_num):
+        return level_num in self.in_memory or level_num in self.on_disk
+
+    def __len__(self):
+        return len(self.in_memory) + len(self.on_disk)
+
+    def level_nums(self):
+        return sorted(set(self.in_memory) | set(self.on_disk))
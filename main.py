@@ -1,29 +1,95 @@
 from typing import Optional, List
 
-import pygame, sys, random, textwrap
-from bres import bresenham
-
-pygame.init()
-
-FONT = pygame.font.SysFont("OCR A Extended", 18)
-FONT_MENUS = pygame.font.SysFont("Lucida Console", 16)
-LEVEL_W, LEVEL_H = 72, 20
-WIDTH, HEIGHT = LEVEL_W*FONT.render("#", True, [0,0,0]).get_width(), (LEVEL_H+1)*FONT.get_height()
-LEVEL_FLOORCOUNT = int((LEVEL_W*LEVEL_H)*0.3)
-
-screen = pygame.display.set_mode([WIDTH, HEIGHT])
+import pygame, sys, os, json, math, random, textwrap, threading
+from collections import deque
+from bres import ray_offsets
+from fov import field_of_view
+from pathing import distance_field, downhill
+from schedule import Scheduler, Timer
+from profiler import profiler
+from layers import LayerStore
+
+LEVEL_W, LEVEL_H = 72, 20 # default cave size. caves can be any size; the window shows a VIEW_W x VIEW_H part
+FLOOR_FRACTION = 0.3
+VIEW_W, VIEW_H = 72, 20
+SCROLL_MARGIN_X, SCROLL_MARGIN_Y = VIEW_W // 4, VIEW_H // 4 # the view recenters once the player gets this close to its edge
+MONSTER_TRACKING_RANGE = 20 # monsters further than this many steps from the player just wander
+TIME_PER_TURN = 12 # game time ticks in a turn at normal speed. divides evenly by 1.5, 2, 3 and 4
+MESSAGE_LOG_LENGTH = 500 # older messages fall off the back of the history
+
+screen = None # opened by main(), so the game can be imported without a window
+
+# everything random the game does draws from one of these, so one seed replays a whole session.
+# separate streams so e.g. a monster taking one more step doesn't change what the next cave looks like
+rngs = {"gen": random.Random(), "combat": random.Random(), "ai": random.Random()}
+
+def seed_rngs(seed):
+    for name, rng in rngs.items():
+        rng.seed(f"{seed}/{name}")
+
+# fonts and everything sized off them are filled in by load_fonts() the first time something gets drawn
+FONT, FONT_MENUS = None, None
+CELL_W, CELL_H = None, None
+WIDTH, HEIGHT = None, None
+SAVE_PATH = os.path.join(os.environ.get("XDG_DATA_HOME", os.path.expanduser("~/.local/share")), "tearl", "save.bin")
+LAYER_MEMORY_BUDGET = 4 * 1024 * 1024 # bytes of frozen visited layers kept in memory before the oldest go to disk
+FONT_CACHE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "tearl", "fonts.json")
+
+def find_font(name, cache):
+    # SysFont scans every installed font, which was most of startup. remember where each one turned up instead
+    if name not in cache or (cache[name] and not os.path.exists(cache[name])):
+        cache[name] = pygame.font.match_font(name)
+    return cache[name]
+
+def load_fonts():
+    global FONT, FONT_MENUS, CELL_W, CELL_H, WIDTH, HEIGHT
+    if FONT: return
+    pygame.font.init()
+    try:
+        with open(FONT_CACHE_PATH) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    known = dict(cache)
+    # a font that isn't installed comes back as None, which gets pygame's default font, same as SysFont did
+    FONT = pygame.font.Font(find_font("OCR A Extended", cache), 18)
+    FONT_MENUS = pygame.font.Font(find_font("Lucida Console", cache), 16)
+    if cache != known:
+        try:
+            os.makedirs(os.path.dirname(FONT_CACHE_PATH), exist_ok=True)
+            with open(FONT_CACHE_PATH, "w") as f:
+                json.dump(cache, f)
+        except OSError: pass
+    CELL_W, CELL_H = FONT.render("#", True, [0,0,0]).get_width(), FONT.get_height()
+    WIDTH, HEIGHT = VIEW_W*CELL_W, (VIEW_H+1)*CELL_H
+
+# there are only a handful of (char, color, bg) combos on screen at once, so render each one once
+glyph_cache = {}
+def get_glyph(char, antialias, color, bg_color=None, font=None):
+    if not FONT: load_fonts()
+    font = font if font else FONT
+    key = (font, char, antialias, tuple(color), tuple(bg_color) if bg_color else None)
+    glyph = glyph_cache.get(key)
+    if glyph is None:
+        glyph = glyph_cache[key] = font.render(char, antialias, color, bg_color)
+        profiler.count("glyph_renders")
+    return glyph
 
 
 LCLICK, RCLICK = 1, 3
 THE_ALPHABET = list("abcdefghijklmnopqrstuvwxyz")
 # an enum if you squint
 class actions:
-    MOVE_N, MOVE_NE, MOVE_E, MOVE_SE, MOVE_S, MOVE_SW, MOVE_W, MOVE_NW, DESCEND = [i for i in range(9)]
+    MOVE_N, MOVE_NE, MOVE_E, MOVE_SE, MOVE_S, MOVE_SW, MOVE_W, MOVE_NW, DESCEND, WAIT, PICK_UP, DROP_KETTLE = [i for i in range(12)]
     tile_move_actions = [MOVE_N, MOVE_NE, MOVE_E, MOVE_SE, MOVE_S, MOVE_SW, MOVE_W, MOVE_NW]
 
 class directions:
     deltas =[[0, -1], [1, -1], [1, 0], [1, 1], [0, 1], [-1, 1], [-1, 0], [-1, -1]]
 
+# the cave walker drifts sideways more than up and down, which suits a wide map.
+# every (dx, dy) pairing, so one draw picks both
+WALK_STEPS = [(dx, dy) for dx in [-1, -1, 0, 1, 1] for dy in [-1, 0, 1]]
+
 move_keybinds = {pygame.K_UP:actions.MOVE_N, pygame.K_DOWN:actions.MOVE_S,
                  pygame.K_LEFT:actions.MOVE_W, pygame.K_RIGHT:actions.MOVE_E,
                  pygame.K_w: actions.MOVE_N, pygame.K_s: actions.MOVE_S,
@@ -54,7 +120,114 @@ class effects:
 class factions:
     PLAYER, CAVE = range(2)
 
+class terrains:
+    WALL, FLOOR, STAIRS = range(3)
+    chars = "#", ".", ">"
+    names = "wall", "floor", "stairs"
+    passable = False, True, True
+
+class TileMemory:
+    # which tiles of one level a unit has seen, one byte per tile
+    def __init__(self, cols, rows):
+        self.ncols, self.nrows = cols, rows
+        self.seen = bytearray(cols * rows)
+
+    def learn(self, coord):
+        self.seen[coord[1] * self.ncols + coord[0]] = 1
+
+    def learn_all(self, coords):
+        seen, ncols = self.seen, self.ncols
+        for x, y in coords:
+            seen[y * ncols + x] = 1
+
+    def clear(self):
+        self.seen = bytearray(self.ncols * self.nrows)
+
+    def __contains__(self, coord):
+        return self.seen[coord[1] * self.ncols + coord[0]] == 1
+
+    def __len__(self):
+        return self.seen.count(1)
+
+class Inventory:
+    # a satchel. items keep their letter slot until they leave it, and what's in it is indexed by
+    # item class and tea variety, so checking for the kettle or counting leaves doesn't scan anything
+    __slots__ = "slots", "slot_of", "by_kind"
+
+    def __init__(self, items=()):
+        self.slots = [] # item or None, by letter
+        self.slot_of = {}
+        self.by_kind = {} # (class, variety) -> items in the order they went in. variety None means any
+        for item in items:
+            self.add(item)
+
+    def kinds(self, item):
+        variety = getattr(item, "variety", None)
+        return [(type(item), None)] + ([(type(item), variety)] if variety is not None else [])
+
+    def add(self, item, slot=None):
+        # slot is only given when putting a satchel back together, e.g. loading a save
+        if item in self.slot_of: return False
+        if slot is None:
+            # the first letter that's free, so nothing else gets relabelled
+            slot = self.slots.index(None) if None in self.slots else len(self.slots)
+        if slot >= len(self.slots):
+            self.slots.extend([None] * (slot + 1 - len(self.slots)))
+        elif self.slots[slot] is not None:
+            return False
+        self.slots[slot] = item
+        self.slot_of[item] = slot
+        for kind in self.kinds(item):
+            self.by_kind.setdefault(kind, {})[item] = None
+        return True
+
+    def remove(self, item):
+        slot = self.slot_of.pop(item, None)
+        if slot is None: return False
+        self.slots[slot] = None
+        while self.slots and self.slots[-1] is None:
+            self.slots.pop()
+        for kind in self.kinds(item):
+            del self.by_kind[kind][item]
+        return True
+
+    def count(self, cls, variety=None):
+        return len(self.by_kind.get((cls, variety), ()))
+
+    def first(self, cls, variety=None):
+        # the earliest added item of that kind still in here, or None
+        return next(iter(self.by_kind.get((cls, variety), ())), None)
+
+    def at(self, slot):
+        return self.slots[slot] if 0 <= slot < len(self.slots) else None
+
+    def __contains__(self, item):
+        return item in self.slot_of
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def __iter__(self):
+        # in letter order
+        return (item for item in self.slots if item is not None)
+
+class SparseGrid(dict):
+    # flat index -> item or unit. almost every cell is empty, so a big cave only pays for what's on it
+    def __missing__(self, index):
+        return None
+
+    def __setitem__(self, index, value):
+        if value is None:
+            self.pop(index, None)
+        else:
+            dict.__setitem__(self, index, value)
+
 class Unit:
+    # slotted, like the items and tiles: a big cave has a lot of goblins
+    __slots__ = "creature_name", "proper_name", "hp", "maxhp", "max_damage", "char", "x", "y", "view_range", \
+        "max_inventory", "inventory", "tea_deck", "max_tea_deck", "memory", "faction", "energy_regen", "effects", \
+        "living", "tile", "parent_level"
+
     def __init__(self, creature_name, proper_name, hp, maxhp, max_damage, char, x, y, parent_level, faction = factions.PLAYER, energy_regen=1):
         self.creature_name = creature_name
         self.proper_name = proper_name
@@ -65,46 +238,52 @@ class Unit:
         self.x, self.y = x, y
         self.view_range = 8
         self.max_inventory = 12
-        self.inventory = []
+        self.inventory = Inventory()
         self.tea_deck = []
         self.max_tea_deck = 12
-        self.memory = []
+        self.memory = TileMemory(parent_level.ncols, parent_level.nrows) if faction == factions.PLAYER else None
         self.faction = faction
-        self.energy = 1
-        self.energy_regen = energy_regen
-        self.effects = {}
+        self.energy_regen = energy_regen # speed multiplier; 2 acts twice as often as the player
+        self.effects = {} # effect -> the scheduler Timer that ends it
         self.living = True
 
+        self.tile, self.parent_level = None, None
         self.set_level(parent_level)
-        self.tile = None
 
 
     def learn_coord(self, coord):
-        if not coord in self.memory:
-            self.memory.append(coord)
+        self.memory.learn(coord)
+
+    def learn_coords(self, coords):
+        self.memory.learn_all(coords)
 
     def set_level(self, new_level, pos = None):
+        if self.parent_level and self.parent_level is not new_level:
+            self.parent_level.remove_unit(self)
         self.parent_level = new_level
         new_level.place_unit(self, pos if pos else [self.x, self.y])
 
     def add_effect(self, effect, duration):
+        # duration is in turns. the effect wears off on its own when its timer comes up
         if duration == 0: return
         if effect == effects.RANDOM_DEBUG:
-            effect = random.choice(effects.special_effects)
+            effect = rngs["combat"].choice(effects.special_effects)
+        scheduler = self.parent_level.parent.scheduler
+        ticks = duration * TIME_PER_TURN
+        if effect in self.effects:
+            ticks += scheduler.next_turn(self.effects[effect]) - scheduler.time
+        self.set_effect_timer(effect, ticks)
+
+    def set_effect_timer(self, effect, ticks):
+        # (re)starts effect so it ends ticks of game time from now
         if not effect in self.effects:
-            self.effects[effect] = duration
-        else:
-            self.effects[effect] += duration
-
-    def process_effects(self):
-        if self.faction == factions.PLAYER:
-            pass
-        elif self.faction == factions.CAVE:
-            pass
-        for effect in self.effects:
-            self.effects[effect] -= 1
-            if self.effects[effect] == 0:
-                del self.effects[effect]
+            self.effects[effect] = Timer(lambda: self.effects.pop(effect, None))
+        self.parent_level.parent.scheduler.schedule(self.effects[effect], ticks)
+
+    def effect_turns_left(self, effect):
+        if not effect in self.effects: return 0
+        scheduler = self.parent_level.parent.scheduler
+        return math.ceil((scheduler.next_turn(self.effects[effect]) - scheduler.time) / TIME_PER_TURN)
 
     def move_to(self, pos):
         try:
@@ -125,7 +304,7 @@ class Unit:
                     kettle.bump(self)
                     return False
 
-            if self.parent_level.get_tile(newpos).is_passable():
+            if self.parent_level.valid_coords(newpos) and self.parent_level.get_tile(newpos).is_passable():
                 newtile = self.parent_level.get_tile(newpos)
                 if newtile.unit:
                     if newtile.unit.faction == self.faction and not effects.CONFUSION in self.effects:
@@ -138,7 +317,7 @@ class Unit:
             if not self.tile.name == "stairs":
                 self.parent_level.parent.add_message("There's no way down right here.")
                 return False
-            if not any(type(i)==Kettle for i in self.inventory):
+            if not self.inventory.count(Kettle):
                 self.parent_level.parent.add_message("You daren't descend without your kettle.")
                 return False
             self.parent_level.parent.enter_new_level()
@@ -149,7 +328,7 @@ class Unit:
         return f"{'the ' if article and not self.proper_name else ''}{name}"
 
     def get_attack(self):
-        return random.randint(0, self.max_damage) + (self.max_damage // 2 if effects.ATK_BOOST else 0)
+        return rngs["combat"].randint(0, self.max_damage) + (self.max_damage // 2 if effects.ATK_BOOST else 0)
 
     def get_defense(self):
         return 2 if effects.DEF_BOOST in self.effects else 0
@@ -162,6 +341,11 @@ class Unit:
             enemy.die()
             fatal = True
         root = self.parent_level.parent
+        if self is root.player:
+            root.stats["damage_dealt"] += damage
+            root.stats["kills"] += fatal
+        elif enemy is root.player:
+            root.stats["damage_taken"] += damage
         root.add_message(f"{self.get_name().capitalize()} "
                          f"{'hit' if damage > 0 else 'missed'} {enemy.get_name()}"
                          f"{'!' if damage==self.max_damage else '.'}")
@@ -171,19 +355,37 @@ class Unit:
     def die(self):
         self.living = False
         if self.inventory:
-            self.drop(self.inventory[0])
-        self.tile.clear_unit()
+            self.drop(next(iter(self.inventory)))
+        if self.parent_level.parent:
+            # whatever it was under doesn't need to wear off any more
+            for timer in self.effects.values():
+                self.parent_level.parent.scheduler.unschedule(timer)
+        self.parent_level.remove_unit(self)
 
     def get_speed(self):
         return 1 if not effects.SPEEDY in self.effects else 1.5
 
+    def get_action_delay(self):
+        # game time one action takes. worked out fresh each action, so speed effects apply from the next one
+        return round(TIME_PER_TURN / (self.energy_regen * self.get_speed()))
+
+    def take_turn(self):
+        # monster ai, called by the scheduler whenever this unit is due. returns the wait until its next turn
+        if not self.living:
+            return None
+        level = self.parent_level
+        player = level.parent.player
+        action = None
+        if max(abs(self.x - player.x), abs(self.y - player.y)) <= MONSTER_TRACKING_RANGE:
+            action = level.step_toward(self, level.distance_field([player.x, player.y]))
+        self.act(action if action is not None else rngs["ai"].choice(actions.tile_move_actions))
+        return self.get_action_delay()
+
     def add_item(self, item):
-        if not item in self.inventory:
-            self.inventory.append(item)
+        return self.inventory.add(item)
 
     def remove_item(self, item):
-        if item in self.inventory:
-            self.inventory.remove(item)
+        return self.inventory.remove(item)
 
     def pick_up(self):
         if self.tile.item and len(self.inventory) < self.max_inventory:
@@ -193,10 +395,10 @@ class Unit:
         return False
 
     def drop(self, item) -> bool:
-        # tiles can only have one item, so this could fail
-        if not self.tile.item:
-            self.tile.item = item
-            self.inventory.remove(item)
+        # tiles can only have one item, so this could fail. nor is there anywhere to put it once you're dead
+        if self.tile and not self.tile.item:
+            self.tile.set_item(item)
+            self.remove_item(item)
             if type(item)==Kettle: self.parent_level.parent.add_message("You set up the kettle. Pick it up after brewing.")
             return True
         return False
@@ -208,53 +410,92 @@ class Unit:
         return False
 
     def rendered(self):
-        return FONT.render(self.char, False, [255, 255, 255], [0, 0, 0])
+        return get_glyph(self.char, False, [255, 255, 255], [0, 0, 0])
 
     def get_viewrange(self):
         return self.view_range
 
 class Item:
+    __slots__ = "name", "char", "tile"
+
     def __init__(self, name, char):
         self.name = name
         self.char = char
         self.tile = None
 
     def rendered(self) -> pygame.Surface:
-        return FONT.render(self.char, False, [255, 255, 255], [0, 0, 0])
+        return get_glyph(self.char, False, [255, 255, 255], [0, 0, 0])
 
 class TeaLeaf:
+    # a cave has thousands of these, so everything that only depends on the variety lives on the class
+    __slots__ = "variety", "tile"
+    char = "%"
+    names = tuple(name + f" tea {'root' if variety==tea_varieties.HERBAL else 'leaf'}"
+                  for variety, name in enumerate(tea_varieties.names))
+
     def __init__(self, variety):
-        self.name = tea_varieties.names[variety] + f" tea {'root' if variety==tea_varieties.HERBAL else 'leaf'}"
-        self.char = "%"
         self.tile = None
         self.variety = variety
-        self.color = tea_varieties.colors[self.variety]
+
+    @property
+    def name(self):
+        return self.names[self.variety]
+
+    @property
+    def color(self):
+        return tea_varieties.colors[self.variety]
 
     def rendered(self, color=None, bg_color=None) -> pygame.Surface:
-        return FONT.render(self.char, True, color if color else self.color, bg_color)
+        return get_glyph(self.char, True, color if color else self.color, bg_color)
 
 class Tea:
+    __slots__ = "variety", "tile"
+    char = "¶"
+    names = tuple(name + " tea" for name in tea_varieties.names)
+    throw_effects = None, effects.POISON, effects.CONFUSION
+    quaff_effects = effects.SPEEDY, effects.HEALING, effects.RANDOM_DEBUG
+
     def __init__(self, variety):
-        self.name = tea_varieties.names[variety] + " tea"
-        self.char = "¶"
         self.tile = None
         self.variety = variety
-        self.throw_effect = [None, effects.POISON, effects.CONFUSION][variety]
-        self.quaff_effect = [effects.SPEEDY, effects.HEALING, effects.RANDOM_DEBUG][variety]
-        self.color = tea_varieties.colors[self.variety]
+
+    @property
+    def name(self):
+        return self.names[self.variety]
+
+    @property
+    def throw_effect(self):
+        return self.throw_effects[self.variety]
+
+    @property
+    def quaff_effect(self):
+        return self.quaff_effects[self.variety]
+
+    @property
+    def color(self):
+        return tea_varieties.colors[self.variety]
 
     def rendered(self, color=None, bg_color=None) -> pygame.Surface:
-        return FONT.render(self.char, True, color if color else self.color, bg_color)
+        return get_glyph(self.char, True, color if color else self.color, bg_color)
 
 class Kettle:
+    __slots__ = "parent", "leaves", "teas", "tile", "brew_timer"
+    char, name = "ó", "kettle"
+    color = (255-40, 215-40, 0)
+
     def __init__(self, root):
         self.parent = root # kettle has to talk to the game root directly. probably unideal
         self.leaves = [        ]
         self.teas = []
-        self.char, self.name = "ó", "kettle"
-        self.color = (255-40, 215-40, 0)
         self.tile = None
-        self.timer, self.prev_timer = 0, 0
+        self.brew_timer = None
+
+    @property
+    def timer(self):
+        # turns until the tea is done, 0 when nothing's brewing
+        if not self.brew_timer: return 0
+        scheduler = self.parent.scheduler
+        return math.ceil((scheduler.next_turn(self.brew_timer) - scheduler.time) / TIME_PER_TURN)
 
     def bump(self, unit):
         if unit.faction != factions.PLAYER: return True
@@ -263,7 +504,7 @@ class Kettle:
         elif self.timer == 0 and self.teas:
             self.dispense_tea(unit)
         elif self.timer != 0:
-            self.parent.add_message(f"{int(self.timer)} turns until tea is done.")
+            self.parent.add_message(f"{self.timer} turns until tea is done.")
         return False
     def activate(self):
         self.parent.set_modal(BrewingWindow(self.parent, self))
@@ -273,58 +514,103 @@ class Kettle:
         [unit.add_tea(t) for t in self.teas]
         self.teas = []
         self.parent.set_modal(TeaDeckWindow(self.parent, self.teas, True))
-        unit.inventory.append(self)
+        unit.add_item(self)
         self.parent.add_message("Picked up the kettle." if len(unit.inventory)<unit.max_inventory
                                 else "You can barely stuff the kettle into your satchel.")
         self.tile.clear_item()
 
         pass
 
-    def tick(self):
-        if self.timer:
-            self.prev_timer = self.timer
-            self.timer -= 1 / self.parent.player.get_speed()
-            if self.timer <= 0 and self.prev_timer > 0:
-                self.parent.add_message("Done brewing!")
-                for leaf in self.leaves:
-                    self.teas.append(Tea(leaf.variety))
-                self.timer = 0
-                self.leaves = []
+    def start_brewing(self, turns):
+        if turns <= 0: return
+        self.brew_timer = Timer(self.finish_brewing)
+        self.parent.scheduler.schedule(self.brew_timer, turns * TIME_PER_TURN)
+
+    def finish_brewing(self):
+        self.brew_timer = None
+        self.parent.add_message("Done brewing!")
+        self.parent.stats["teas_brewed"] += len(self.leaves)
+        for leaf in self.leaves:
+            self.teas.append(Tea(leaf.variety))
+        self.leaves = []
+        if self.tile: self.tile.invalidate()
 
     def rendered(self, color=None, bg_color=None) -> pygame.Surface:
         if self.timer: color = (255, 215, 0)
-        return FONT.render(self.char, True, color if color else self.color, bg_color)
+        return get_glyph(self.char, True, color if color else self.color, bg_color)
 
 class Tile:
-    def __init__(self, char, passable, name, x, y, item=None, unit=None):
-        self.char = char
-        self.passable = passable
-        self.name = name
+    # a view onto one cell of a Level. terrain, item and unit actually live in the level's flat arrays,
+    # and what a terrain looks like and does lives in terrains, so a tile is just where it is
+    __slots__ = "parent", "x", "y", "index"
+
+    def __init__(self, parent, x, y):
+        self.parent = parent
         self.x, self.y = x, y
-        self.item = item
-        self.unit = unit
+        self.index = y * parent.ncols + x
+
+    @property
+    def terrain(self):
+        return self.parent.terrain[self.index]
+
+    @property
+    def char(self):
+        return terrains.chars[self.terrain]
+
+    @property
+    def name(self):
+        return terrains.names[self.terrain]
+
+    @property
+    def passable(self):
+        return self.parent.passable[self.index] == 1
+
+    @property
+    def item(self):
+        return self.parent.item_grid[self.index]
+
+    @item.setter
+    def item(self, item):
+        self.parent.item_grid[self.index] = item
+
+    @property
+    def unit(self):
+        return self.parent.unit_grid[self.index]
+
+    @unit.setter
+    def unit(self, unit):
+        self.parent.unit_grid[self.index] = unit
+
+    def invalidate(self):
+        # tell the game root this cell needs redrawing
+        if self.parent and self.parent.parent:
+            self.parent.parent.invalidate_cell(self.x, self.y)
 
     def set_unit(self, unit):
         self.clear_unit()
         unit.tile = self
         unit.x, unit.y = self.x, self.y
         self.unit = unit
+        self.invalidate()
 
     def clear_unit(self):
         try:
             self.unit.tile = None
         except:pass
         self.unit = None
+        self.invalidate()
 
     def set_item(self, item: Item):
         self.clear_item()
         self.item = item
         item.tile = self
+        self.invalidate()
 
     def clear_item(self):
         if self.item:
             self.item.tile = None
         self.item = None
+        self.invalidate()
 
     def is_passable(self):
         return self.passable
@@ -335,7 +621,7 @@ class Tile:
         elif self.item:
             return self.item.rendered()
         else:
-            return FONT.render(self.char, False, color, bg_color)
+            return get_glyph(self.char, False, color, bg_color)
 
 class Level:
     def __init__(self, cols, rows, level_num):
@@ -343,50 +629,162 @@ class Level:
         self.ncols = cols
         self.nrows = rows
         self.level_num = level_num
-        self.tilemap = [[None for c in range(cols)] for r in range(rows)]
-
-    def generate(self, floorgoal):
-        self.tilemap = [[Tile("#", False, "wall", c, r) for c in range(self.ncols)] for r in range(self.nrows)]
-        walkerx, walkery = self.ncols // 2, self.nrows // 2
-        minx, miny, maxx, maxy = walkerx, walkery, walkerx, walkery
-        floorcount = 0
-
-        while floorcount < floorgoal:
-            tile = self.get_tile([walkerx, walkery])
-            if tile.name == "wall":
-                self.set_tile(walkerx, walkery, Tile(".", True, "floor", walkerx, walkery))
-                floorcount += 1
-            if random.randint(0, 150) < 1:
-                self.get_tile([walkerx, walkery]).set_item(TeaLeaf(tea_varieties.BLACK))
-            walkerx = min(max(walkerx + random.choice([-1,-1, 0, 1, 1]), 0), self.ncols-2)
-            walkery = min(max(walkery + random.choice([-1,0, 1]), 0), self.nrows - 2)
-        self.set_tile(walkerx, walkery, Tile(">", True, "stairs", walkerx, walkery))
-        start_candidates = [[c.x, c.y] for c in filter(lambda t: t.passable and dist([t.x, t.y], [walkerx, walkery])>10,
-                                  self.all_tiles())]
-        return random.choice(start_candidates) \
-            if start_candidates \
-            else [[c.x, c.y] for c in filter(lambda t: t.passable, self.all_tiles())]
+        # struct-of-arrays map, indexed y*ncols + x. Tile objects are just views onto these
+        self.terrain = bytearray(cols * rows)
+        self.passable = bytearray(cols * rows)
+        self.item_grid = SparseGrid()
+        self.unit_grid = SparseGrid()
+        # bumped whenever terrain changes so cached fov knows to recompute
+        self.terrain_version = 0
+        self.fov_key, self.fov = None, set()
+        self.path_key, self.path_field = None, {}
+        # live units by faction. dicts rather than sets so turn order stays stable
+        self.units = {}
+
+    def generate(self, floorgoal, rng=None, max_steps=None):
+        # rng lets a worker thread generate without touching the shared generation stream
+        rng = rng if rng else rngs["gen"]
+        ncols, nrows = self.ncols, self.nrows
+        size = ncols * nrows
+        # carve straight into a mask rather than through set_terrain; nothing is watching this level yet
+        carved = bytearray(size)
+        self.item_grid = SparseGrid()
+        self.unit_grid = SparseGrid()
+        walkerx, walkery = ncols // 2, nrows // 2
+        maxx, maxy = ncols - 2, nrows - 2
+        floorcount, steps = 0, 0
+        # past this the walk is just wandering over old floor, so settle for a smaller cave
+        max_steps = max_steps if max_steps else floorgoal * 100
+        # a leaf drops on 1 in 151 steps; skip straight to the next one instead of rolling every step
+        leaf_odds = math.log(1 - 1/151)
+        next_leaf = int(math.log(1 - rng.random()) / leaf_odds)
+
+        while floorcount < floorgoal and steps < max_steps:
+            # draw the walk a chunk at a time
+            chunk = max(64, floorgoal - floorcount)
+            for dx, dy in rng.choices(WALK_STEPS, k=chunk):
+                i = walkery * ncols + walkerx
+                if not carved[i]:
+                    carved[i] = 1
+                    floorcount += 1
+                if steps == next_leaf:
+                    leaf = TeaLeaf(tea_varieties.BLACK)
+                    if self.item_grid[i]: self.item_grid[i].tile = None
+                    self.item_grid[i], leaf.tile = leaf, Tile(self, walkerx, walkery)
+                    next_leaf += 1 + int(math.log(1 - rng.random()) / leaf_odds)
+                steps += 1
+                if floorcount >= floorgoal or steps >= max_steps:
+                    break
+                walkerx, walkery = walkerx + dx, walkery + dy
+                if walkerx < 0: walkerx = 0
+                elif walkerx > maxx: walkerx = maxx
+                if walkery < 0: walkery = 0
+                elif walkery > maxy: walkery = maxy
+
+        self.passable = carved
+        self.terrain = bytearray(carved) # terrains.FLOOR is 1, so the mask doubles as terrain ids
+        self.terrain_version += 1
+        self.set_terrain(walkerx, walkery, terrains.STAIRS)
+        floors = self.passable_coords()
+        start_candidates = [c for c in floors if (c[0]-walkerx)**2 + (c[1]-walkery)**2 > 10**2]
+        return rng.choice(start_candidates if start_candidates else floors)
         #print("generation done")
 
     def los_clear(self, from_coord, to_coord):
-        line = bresenham(from_coord, to_coord)[1:-1]
-        line = filter(lambda f: self.valid_coords(f), line)
-        if all([self.get_tile(t).passable for t in line]):
-            return True
+        # whether nothing between the two blocks the way. cells off the map don't count
+        x, y = from_coord
+        passable, ncols, nrows = self.passable, self.ncols, self.nrows
+        for ox, oy in ray_offsets(to_coord[0] - x, to_coord[1] - y):
+            cx, cy = x + ox, y + oy
+            if 0 <= cx < ncols and 0 <= cy < nrows and not passable[cy*ncols + cx]:
+                return False
+        return True
+
+    def los_clear_many(self, from_coord, targets):
+        # los_clear from one spot to each of targets, e.g. every monster that might see the player
+        # or everything a tea could be thrown at. one call instead of one per target
+        x, y = from_coord
+        passable, ncols, nrows = self.passable, self.ncols, self.nrows
+        results = []
+        for tx, ty in targets:
+            clear = True
+            for ox, oy in ray_offsets(tx - x, ty - y):
+                cx, cy = x + ox, y + oy
+                if 0 <= cx < ncols and 0 <= cy < nrows and not passable[cy*ncols + cx]:
+                    clear = False
+                    break
+            results.append(clear)
+        return results
+
+    def visible_coords(self, unit):
+        # only recomputed when the viewer moves, their view range changes or the terrain does
+        key = (unit.x, unit.y, unit.get_viewrange(), self.terrain_version)
+        if key != self.fov_key:
+            self.fov = field_of_view((unit.x, unit.y), unit.get_viewrange(),
+                                     lambda x, y: not self.passable[y*self.ncols + x],
+                                     lambda x, y: self.valid_coords([x, y]))
+            self.fov_key = key
+        return self.fov
+
+    def distance_field(self, goal):
+        # steps to goal from everywhere within MONSTER_TRACKING_RANGE. shared by every monster,
+        # and only redone when the goal moves or the terrain changes
+        key = (goal[0], goal[1], self.terrain_version)
+        if key != self.path_key:
+            self.path_field = distance_field(self.passable, self.ncols, self.nrows, goal, MONSTER_TRACKING_RANGE)
+            self.path_key = key
+        return self.path_field
+
+    def step_toward(self, unit, field):
+        # the move action taking unit downhill on field, or None if it's out of range or boxed in
+        unit_grid = self.unit_grid
+        return downhill(field, self.ncols, self.nrows, [unit.x, unit.y],
+                        lambda i: unit_grid[i] is not None and unit_grid[i].faction == unit.faction)
+
     def place_unit(self, unit, pos):
         #print(f"placing {unit.name} at {pos}")
         tile = self.get_tile(pos)
         #print(f"tile at {pos} is {tile}")
+        if tile.unit and tile.unit is not unit:
+            return False
         try:
             tile.set_unit(unit)
-        except: pass
+            faction_units = self.units.setdefault(unit.faction, {})
+            if unit not in faction_units:
+                faction_units[unit] = None
+                if self.parent: self.parent.unit_arrived(unit)
+            return True
+        except: return False
+
+    def remove_unit(self, unit):
+        faction_units = self.units.get(unit.faction, {})
+        if unit in faction_units:
+            del faction_units[unit]
+            if self.parent: self.parent.unit_left(unit)
+        if unit.tile and unit.tile.parent is self and unit.tile.unit is unit:
+            unit.tile.clear_unit()
+
+    def unit_at(self, pos):
+        return self.unit_grid[pos[1] * self.ncols + pos[0]] if self.valid_coords(pos) else None
+
+    def units_within(self, pos, radius, faction=None):
+        candidates = self.units.get(faction, {}) if faction is not None \
+            else [u for units in self.units.values() for u in units]
+        px, py = pos
+        if (2*radius + 1) ** 2 < len(candidates):
+            # fewer cells in range than units to check, so look the cells up instead
+            unit_grid, ncols = self.unit_grid, self.ncols
+            candidates = [u for y in range(max(0, py-radius), min(self.nrows, py+radius+1))
+                          for u in (unit_grid.get(y*ncols + x) for x in range(max(0, px-radius), min(ncols, px+radius+1)))
+                          if u and (faction is None or u.faction == faction)]
+        return [u for u in candidates if (u.x-px)**2 + (u.y-py)**2 <= radius*radius]
 
     def move_unit(self, unit, newpos) -> bool:
         # returns True on success, False on failure
         #print(f"moving to {newpos}")
         if not unit.parent_level == self:
             return False
-        if not self.valid_coords(newpos):
+        if not self.valid_coords(newpos) or self.unit_at(newpos):
             return False
         unit.tile.clear_unit()
         self.place_unit(unit, newpos)
@@ -398,49 +796,63 @@ class Level:
                (0 <= coords[1] < self.nrows)
 
     def all_tiles(self):
-        tiles = []
-        for row in self.tilemap:
-            for tile in row:
-                tiles.append(tile)
-        return tiles
+        return [Tile(self, x, y) for y in range(self.nrows) for x in range(self.ncols)]
+
+    def passable_coords(self):
+        ncols = self.ncols
+        return [[i % ncols, i // ncols] for i, p in enumerate(self.passable) if p]
 
     def by_faction(self, faction):
-        return filter(lambda u: u.faction == faction,
-                      [t.unit for t in list(filter(lambda t:t.unit,
-                                  [t for t in self.all_tiles()]))])
-    def render(self, surf):
-        ppos = [self.parent.player.x, self.parent.player.y]
-        nearby_tiles = filter(lambda t: dist([t.y, t.y], ppos) <= self.parent.player.get_viewrange(),
-                              self.all_tiles())
-        for row in self.tilemap:
-            for tile in row:
-                tpos = [tile.x, tile.y]
-                #print(f"rendering tile at {tpos}")
-                ppos = [self.parent.player.x, self.parent.player.y]
-                if dist(tpos, ppos) <= self.parent.player.get_viewrange():
-                    if self.los_clear(tpos, ppos):
-                        rendered = tile.rendered()
-                        player.learn_coord([tile.x, tile.y])
-                        surf.blit(rendered, [tile.x*rendered.get_width(), tile.y*rendered.get_height()])
-                    elif [tile.x, tile.y] in player.memory:
-                        rendered = FONT.render(tile.char, False, [100, 100, 100])
-                        surf.blit(rendered, [tile.x * rendered.get_width(), tile.y * rendered.get_height()])
-                elif [tile.x, tile.y] in player.memory:
-                    rendered = FONT.render(tile.char, False, [100, 100, 100])
-                    surf.blit(rendered, [tile.x * rendered.get_width(), tile.y * rendered.get_height()])
-                #rendered = tile.rendered()
-                #surf.blit(rendered, [tile.x*rendered.get_width(), tile.y*rendered.get_height()])
+        # a copy, since units can die while the caller is iterating
+        return list(self.units.get(faction, {}))
+    def render(self, surf, coords=None, view=None):
+        # draws every tile in view, or only the given coords in it (clearing them first). returns the rects touched.
+        # view is (x, y, cols, rows) of the map to draw at the surface's top left; the whole map by default
+        start = profiler.start()
+        vx, vy, vcols, vrows = view if view else (0, 0, self.ncols, self.nrows)
+        player = self.parent.player
+        visible = self.visible_coords(player)
+        load_fonts()
+        right, bottom = min(vx + vcols, self.ncols), min(vy + vrows, self.nrows)
+        if coords is None:
+            coords = [(x, y) for y in range(vy, bottom) for x in range(vx, right)]
+            clear = False
+        else:
+            coords = [c for c in coords if vx <= c[0] < right and vy <= c[1] < bottom]
+            clear = True
+        blits, rects = [], []
+        # glyphs are clipped to their cell so partial redraws can't leave half a neighbour behind
+        cell_area = pygame.Rect(0, 0, CELL_W, CELL_H)
+        for x, y in coords:
+            rect = pygame.Rect((x-vx)*CELL_W, (y-vy)*CELL_H, CELL_W, CELL_H)
+            if clear:
+                surf.fill([0, 0, 0], rect)
+                rects.append(rect)
+            tile = Tile(self, x, y)
+            if (x, y) in visible:
+                blits.append((tile.rendered(), rect, cell_area))
+            elif (x, y) in player.memory:
+                blits.append((get_glyph(tile.char, False, [100, 100, 100]), rect, cell_area))
+        surf.blits(blits, False)
+        profiler.count("blits", len(blits))
+        profiler.stop("level_render", start)
+        return rects
 
     def get_tile(self, pos) -> [Optional[Tile]]:
-        return self.tilemap[pos[1]][pos[0]]
+        if not self.valid_coords(pos):
+            raise IndexError(f"{pos} is off the map")
+        return Tile(self, pos[0], pos[1])
 
 
-    def set_tile(self, x, y, new_tile):
-        try:
-            self.tilemap[y][x] = new_tile
-            return True
-        except:
+    def set_terrain(self, x, y, terrain):
+        if not self.valid_coords([x, y]):
             return False
+        i = y * self.ncols + x
+        self.terrain[i] = terrain
+        self.passable[i] = terrains.passable[terrain]
+        self.terrain_version += 1
+        Tile(self, x, y).invalidate()
+        return True
 
 def get_subwindow_dimensions(percentage):
     surf_rect = pygame.Rect([0, 0, screen.get_width() * percentage, screen.get_height() * percentage])
@@ -452,95 +864,318 @@ def get_subwindow_dimensions(percentage):
     pygame.draw.rect(surf, [255, 255, 255], border_rect, 2, 2)
     return surf, border_rect
 
+class LevelPregenerator:
+    # generates the next cave layer on a worker thread so descending doesn't hitch.
+    # the seed is drawn up front, so the level comes out the same whether the worker finished or not
+    def __init__(self, cols, rows, level_num, floorgoal, seed=None):
+        self.cols, self.rows, self.level_num, self.floorgoal = cols, rows, level_num, floorgoal
+        self.seed = seed if seed is not None else rngs["gen"].getrandbits(64)
+        self.result = None
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def work(self):
+        level = Level(self.cols, self.rows, self.level_num)
+        start = level.generate(self.floorgoal, random.Random(self.seed))
+        self.result = level, start
+
+    def take(self):
+        # the finished level. if the worker isn't done, wait for it: starting over on this thread would
+        # only fight it for the GIL, and come out the same anyway
+        self.thread.join()
+        return self.result
+
 class GameRoot:
-    def __init__(self, level: Level, player: Unit):
-        self.level = level
-        self.level.parent = self
+    def __init__(self, level: Level, player: Unit, pregenerate=True):
+        self.scheduler = Scheduler()
+        self.visited = LayerStore(LAYER_MEMORY_BUDGET) # layers the player has left, frozen
+        self.level = None
         self.player = player
+        self.adopt_level(level)
+        self.pregenerate = pregenerate
+        self.next_level = None
         self.active_modal = None
         self.active_kettle = None
-        self.messages, self.message_log = [], []
+        self.messages = deque() # still to be shown, already wrapped to fit the top line
+        self.message_log = deque(maxlen=MESSAGE_LOG_LENGTH)
+        self.message_surfaces = {} # rendered top lines, by text
         self.turns = 0
+        # running totals for balance runs (see batch.py)
+        self.stats = {"damage_dealt": 0, "damage_taken": 0, "kills": 0, "teas_brewed": 0}
+        self.recorder = None # replay.Recorder, when the session is being recorded
+        self.save_path = SAVE_PATH # None when replaying, so F5 doesn't overwrite a real save
+        # dirty tracking for render()
+        self.dirty_cells = set()
+        self.full_redraw = True
+        self.last_visible = None
+        self.last_message_line, self.last_status_line = None, None
+        self.last_modal_surface = None
+        self.camera = (0, 0)
+        self.start_pregenerating()
+        self.look()
+
+    def invalidate_cell(self, x, y):
+        self.dirty_cells.add((x, y))
+
+    def invalidate_all(self):
+        self.full_redraw = True
 
     def add_message(self, message):
-        if not len(message) > (LEVEL_W-len("... --press any key--")):
+        if not len(message) > (VIEW_W-len("... --press any key--")):
             self.messages.append(message)
         else:
-            lines = textwrap.wrap(message, LEVEL_W-len("...--press any key--"))
+            lines = textwrap.wrap(message, VIEW_W-len("...--press any key--"))
             for line in lines:
                 self.messages.append(line+"...")
 
     def pop_message(self):
-        self.message_log.append(self.messages.pop(0))
+        self.message_log.append(self.messages.popleft())
+
+    def message_surface(self, text):
+        surf = self.message_surfaces.get(text)
+        if surf is None:
+            # combat spam is mostly the same few lines; clearing now and then keeps a long session from piling up
+            if len(self.message_surfaces) > 64:
+                self.message_surfaces.clear()
+            surf = self.message_surfaces[text] = FONT_MENUS.render(text, True, [255, 255, 255], [0,0,0])
+            profiler.count("glyph_renders")
+        return surf
 
     def handle(self, ev:pygame.event.Event, delegate=True):
+        # modals pass some events back up with delegate off; those were already recorded and timed
+        if not delegate:
+            return self.handle_event(ev, delegate)
+        if self.recorder:
+            self.recorder.record(ev)
+        start = profiler.start()
+        self.handle_event(ev, delegate)
+        profiler.stop("handle", start)
+
+    def handle_event(self, ev, delegate):
         if self.active_modal and delegate:
             self.active_modal.handle(ev)
         else:
-            player_acted = False
             if ev.type == pygame.QUIT:
                 pygame.quit()
                 sys.exit()
             if ev.type == pygame.KEYDOWN:
                 #print(ev.key)
+                if ev.key == pygame.K_F5:
+                    self.save_game()
+                    return
                 if self.messages:
                     self.pop_message()
                     if len(self.messages) > 1: return
                 elif len(self.messages) == 1:
                     self.pop_message()
                 if ev.key in move_keybinds:
-                    player_acted = self.player.act(move_keybinds[event.key])
-                    if self.player.tile.item:
-                        self.player.pick_up()
+                    self.do_action(move_keybinds[ev.key])
                 if ev.key == pygame.K_i:
                     self.set_modal(InventoryWindow(self))
                 if ev.key == pygame.K_g:
-                    self.player.pick_up()
+                    self.do_action(actions.PICK_UP)
                 if ev.key == pygame.K_PERIOD:
-                    player_acted = True
+                    self.do_action(actions.WAIT)
             if ev.type == pygame.TEXTINPUT:
                 if ev.text == "@":
                     self.set_modal(StatusWindow(self))
                 elif ev.text == ">":
-                    self.player.act(actions.DESCEND)
-            if player_acted:
-                self.advance()
+                    self.do_action(actions.DESCEND)
+
+    def do_action(self, action):
+        # the player's turn, without any pygame events involved. returns whether the monsters got to go
+        player_acted = False
+        if not self.player.living:
+            return False
+        if action in actions.tile_move_actions or action == actions.DESCEND:
+            player_acted = self.player.act(action)
+            if self.player.tile and self.player.tile.item:
+                self.player.pick_up()
+        elif action == actions.PICK_UP:
+            self.player.pick_up()
+        elif action == actions.DROP_KETTLE:
+            # what picking it out of the satchel window does. setting it up takes no time
+            if self.active_kettle in self.player.inventory:
+                self.player.drop(self.active_kettle)
+        elif action == actions.WAIT:
+            player_acted = True
+        if player_acted:
+            self.advance()
+        self.look()
+        return player_acted
+
+    def look(self):
+        # the player remembers what they've seen. part of the turn, not the drawing, so headless runs and replays see the same
+        self.player.learn_coords(self.level.visible_coords(self.player))
 
     def advance(self):
-        kettle = self.active_kettle
-        if kettle:
-            kettle.tick()
-        monsters = self.level.by_faction(factions.CAVE)
-        for monster in monsters:
-            if monster.energy > 1:
-                monster.act(random.choice(actions.tile_move_actions))
-            monster.energy += (monster.energy_regen / player.get_speed())
+        # the player just acted, which took them get_action_delay(). everything due before then goes now
+        start = profiler.start()
+        self.scheduler.run_until(self.scheduler.time + self.player.get_action_delay())
         self.turns += 1
+        profiler.stop("advance", start)
+
+    def unit_arrived(self, unit):
+        if unit is not self.player:
+            self.scheduler.schedule(unit, unit.get_action_delay())
+
+    def unit_left(self, unit):
+        self.scheduler.unschedule(unit)
+
+    def adopt_level(self, level):
+        # make level the live one, moving the old level's monsters off the schedule and the new one's on
+        if self.level:
+            for unit in [u for units in self.level.units.values() for u in units]:
+                self.unit_left(unit)
+        self.level = level
+        level.parent = self
+        for unit in [u for units in level.units.values() for u in units]:
+            self.unit_arrived(unit)
+
+    def start_pregenerating(self):
+        # deeper layers come out the same size as this one. one that's been visited already just gets thawed
+        if self.pregenerate and self.level.level_num+1 not in self.visited:
+            cols, rows = self.level.ncols, self.level.nrows
+            self.next_level = LevelPregenerator(cols, rows, self.level.level_num+1, int(cols*rows*FLOOR_FRACTION))
+
+    def freeze_level(self):
+        # pack the layer being left into the visited store, as it is right now
+        import savegame
+        self.visited.put(self.level.level_num, savegame.freeze_level(self.level, self.player, self.scheduler))
+
+    def return_to_level(self, level_num):
+        # back to a layer left earlier, with the player where they left it. False if it was never visited
+        if level_num not in self.visited:
+            return False
+        import savegame
+        level, pos, memory, pending = savegame.thaw_level(self.visited.pop(level_num), self)
+        self.freeze_level()
+        self.player.set_level(level, pos)
+        self.player.memory = memory
+        self.adopt_level(level)
+        for order, schedule in sorted(pending, key=lambda p: p[0]):
+            schedule()
+        self.next_level = None
+        self.invalidate_all()
+        self.start_pregenerating()
+        self.look()
+        return True
 
     def enter_new_level(self):
-        new_level = Level(LEVEL_W, LEVEL_H, self.level.level_num+1 if self.level else 0)
-        start = new_level.generate(LEVEL_FLOORCOUNT)
+        if self.return_to_level(self.level.level_num+1):
+            return
+        self.freeze_level()
+        if self.next_level:
+            new_level, start = self.next_level.take()
+        else:
+            cols, rows = self.level.ncols, self.level.nrows
+            new_level = Level(cols, rows, self.level.level_num+1)
+            start = new_level.generate(int(cols*rows*FLOOR_FRACTION))
         self.player.set_level(new_level, start)
-        self.player.memory = []
-        new_level.parent = self
-        self.level = new_level
+        self.player.memory = TileMemory(new_level.ncols, new_level.nrows)
+        self.adopt_level(new_level)
+        self.invalidate_all()
+        self.start_pregenerating()
+
+    def view(self):
+        # the part of the map on screen, as (x, y, cols, rows)
+        return self.camera[0], self.camera[1], VIEW_W, VIEW_H
+
+    def follow_player(self):
+        # where the camera should be. it only moves once the player nears the edge of the view, and then
+        # recenters on them, so walking around mostly gets cheap partial redraws
+        cx, cy = self.camera
+        px, py = self.player.x, self.player.y
+        if not cx + SCROLL_MARGIN_X <= px < cx + VIEW_W - SCROLL_MARGIN_X: cx = px - VIEW_W // 2
+        if not cy + SCROLL_MARGIN_Y <= py < cy + VIEW_H - SCROLL_MARGIN_Y: cy = py - VIEW_H // 2
+        return max(0, min(cx, self.level.ncols - VIEW_W)), max(0, min(cy, self.level.nrows - VIEW_H))
+
+    def cells_under(self, rect):
+        # map cells under a rect of the screen
+        cx, cy = self.camera
+        return {(cx + x, cy + y) for y in range(rect.top // CELL_H, min(VIEW_H, (rect.bottom - 1) // CELL_H + 1))
+                for x in range(rect.left // CELL_W, min(VIEW_W, (rect.right - 1) // CELL_W + 1))}
+
+    def rows_under(self, rect):
+        # map cells a ui strip is drawn over, so they can be restored when it changes
+        return self.cells_under(pygame.Rect(0, rect.top, WIDTH, rect.height))
 
     def render(self, surf:pygame.Surface):
-        self.level.render(surf)
-        if self.messages:
-            surf.blit(FONT_MENUS.render(self.messages[0]+(" --press any key--" if len(self.messages) > 1 else ""), True, [255, 255, 255], [0,0,0]), [0,0])
+        # only redraws what changed since the last call. returns the rects to pass to display.update
+        load_fonts()
+        camera = self.follow_player()
+        if camera != self.camera:
+            self.camera = camera
+            self.full_redraw = True
+        visible = self.level.visible_coords(self.player)
+        if visible is not self.last_visible:
+            if self.last_visible is not None:
+                self.dirty_cells |= visible ^ self.last_visible
+            self.last_visible = visible
+
+        message_line = self.messages[0]+(" --press any key--" if len(self.messages) > 1 else "") \
+            if self.messages else None
+        message_rect = pygame.Rect(0, 0, WIDTH, FONT_MENUS.get_height())
         pl = self.player
         status_line = \
             f"{pl.proper_name}  {pl.hp}/{pl.maxhp}HP  " \
             f"Satchel: {len(pl.inventory)}/{pl.max_inventory} items  " \
             f"Cave layer {self.level.level_num}  " \
             f"Turn {self.turns}"
-        surf.blit(FONT_MENUS.render(status_line, True, [255, 255, 255]), [0, HEIGHT-FONT_MENUS.get_height()-1])
+        status_y = HEIGHT-FONT_MENUS.get_height()-1
+        status_rect = pygame.Rect(0, status_y, WIDTH, HEIGHT-status_y)
+
+        if self.full_redraw:
+            surf.fill([0, 0, 0])
+            self.level.render(surf, None, self.view())
+            redraw_message, redraw_status = True, True
+            dirty = [surf.get_rect()]
+        else:
+            redraw_message = message_line != self.last_message_line
+            redraw_status = status_line != self.last_status_line
+            if redraw_message: self.dirty_cells |= self.rows_under(message_rect)
+            if redraw_status: self.dirty_cells |= self.rows_under(status_rect)
+            dirty = self.level.render(surf, self.dirty_cells, self.view()) if self.dirty_cells else []
+            # the ui strips sit on top of the map, so redraw them if anything underneath was touched
+            redraw_message = redraw_message or any(message_rect.colliderect(r) for r in dirty)
+            redraw_status = redraw_status or any(status_rect.colliderect(r) for r in dirty)
+            if redraw_status:
+                surf.fill([0, 0, 0], status_rect.clip(pygame.Rect(0, VIEW_H*CELL_H, WIDTH, HEIGHT)))
+                dirty.append(status_rect)
+        if redraw_message and message_line:
+            rendered = self.message_surface(message_line)
+            surf.blit(rendered, [0,0])
+            profiler.count("blits")
+            dirty.append(rendered.get_rect())
+        if redraw_status:
+            surf.blit(FONT_MENUS.render(status_line, True, [255, 255, 255]), [0, status_y])
+            profiler.count("blits")
+            profiler.count("glyph_renders")
         if self.active_modal:
             rendered:pygame.Surface = self.active_modal.rendered()
             centered_rect = rendered.get_rect()
             centered_rect.center = surf.get_rect().center
-            surf.blit(rendered, centered_rect)
+            # only put back if it was rebuilt or something got drawn over it
+            if rendered is not self.last_modal_surface or any(centered_rect.colliderect(r) for r in dirty):
+                surf.blit(rendered, centered_rect)
+                profiler.count("blits")
+                dirty.append(centered_rect)
+        self.last_modal_surface = rendered if self.active_modal else None
+
+        self.dirty_cells = set()
+        self.full_redraw = False
+        self.last_message_line, self.last_status_line = message_line, status_line
+        return dirty
+
+    def save_game(self):
+        # a dead questant's save could only ever be loaded to watch them lie there
+        if not self.player.living:
+            self.add_message("There's no saving this game now.")
+            return
+        if self.save_path:
+            import savegame
+            savegame.save(self, self.save_path)
+        self.add_message("Game saved.")
 
     def set_kettle(self, kettle):
         self.active_kettle = kettle
@@ -548,16 +1183,38 @@ class GameRoot:
     def set_modal(self, modal):
         self.active_modal = modal
         self.active_modal.parent = self
+        self.invalidate_all()
 
     def clear_modal(self):
         self.active_modal.parent = None
         self.active_modal = None
+        self.invalidate_all()
+
+class CachedWindow:
+    # modals build their surface once and hand the same one back every frame until what they show changes.
+    # state() is whatever the picture depends on; invalidate() forces a rebuild for anything it misses
+    surface, built_state = None, None
 
-class StatusWindow:
+    def state(self):
+        return None
+
+    def invalidate(self):
+        self.surface = None
+
+    def rendered(self) -> pygame.Surface:
+        start = profiler.start()
+        state = self.state()
+        if self.surface is None or state != self.built_state:
+            self.surface, self.built_state = self.build(), state
+            profiler.count("modal_builds")
+        profiler.stop("modal_rendered", start)
+        return self.surface
+
+class StatusWindow(CachedWindow):
     def __init__(self, parent:GameRoot):
         self.parent = parent
 
-    def rendered(self) -> pygame.Surface:
+    def build(self) -> pygame.Surface:
         return pygame.Surface([10, 10])
 
     def handle(self, ev):
@@ -569,11 +1226,14 @@ class StatusWindow:
     def close(self):
         self.parent.clear_modal()
 
-class InventoryWindow:
+class InventoryWindow(CachedWindow):
     def __init__(self, parent:GameRoot):
         self.parent = parent
 
-    def rendered(self) -> pygame.Surface:
+    def state(self):
+        return tuple(self.parent.player.inventory.slots)
+
+    def build(self) -> pygame.Surface:
         antialias_menu = True
         surf_rect = pygame.Rect([0,0,screen.get_width()*0.8, screen.get_height()*0.8])
         surf_rect.center = screen.get_rect().center
@@ -584,16 +1244,13 @@ class InventoryWindow:
         pygame.draw.rect(surf, [255, 255, 255], border_rect, 2, 2)
         title_rendered = FONT_MENUS.render("Your Satchel", antialias_menu, [255, 255, 255])
 
-        names = [i.name for i in self.parent.player.inventory]
-        name_blits = []
-
-        for i in range(len(names)):
-
-            name = names[i]
+        # laid out by letter slot, so an item stays put when something before it is dropped
+        for i, item in enumerate(self.parent.player.inventory.slots):
+            if item is None: continue
             x = border_rect.centerx - (120)*(1,-1)[i>5] - 50
             y = border_rect.top + 30*((i) % 6) + 25
-            surf.blit(FONT_MENUS.render(name, antialias_menu, [255, 255, 255]),[x, y])
-            surf.blit(self.parent.player.inventory[i].rendered(), [x-20, y])
+            surf.blit(FONT_MENUS.render(item.name, antialias_menu, [255, 255, 255]),[x, y])
+            surf.blit(item.rendered(), [x-20, y])
             surf.blit(FONT_MENUS.render(THE_ALPHABET[i], True, [255, 255, 255]),
                       [x - 50, y])
 
@@ -613,8 +1270,8 @@ class InventoryWindow:
         elif ev.type == pygame.TEXTINPUT:
             key = ev.text
             i = THE_ALPHABET.index(key)
-            if i<len(self.parent.player.inventory):
-                item = self.parent.player.inventory[i]
+            item = self.parent.player.inventory.at(i)
+            if item:
                 if self.parent.player.drop(item):
                     self.close()
 
@@ -623,19 +1280,18 @@ class InventoryWindow:
     def close(self):
         self.parent.clear_modal()
 
-class BrewingWindow:
+class BrewingWindow(CachedWindow):
     def __init__(self, parent: GameRoot, kettle:Kettle):
         self.parent = parent
         self.kettle = kettle
 
-        self.satchel_contents =list(filter(lambda i: type(i)==TeaLeaf,
-            parent.player.inventory))
-        self.kettle_contents = []
         self.tab = 0
         self.selected = 0
 
+    def state(self):
+        return self.tab, self.selected, tuple(self.parent.player.inventory.slots), tuple(self.kettle.leaves)
 
-    def rendered(self):
+    def build(self):
         antialias_menu = True
         surf, border_rect = get_subwindow_dimensions(0.8)
         pygame.draw.line(surf, [255, 255, 255], [border_rect.centerx, border_rect.top + 30], [border_rect.centerx, border_rect.bottom - 30], 2)
@@ -646,15 +1302,10 @@ class BrewingWindow:
         surf.blit(satchel_label, [border_rect.width // 4 - kettle_label.get_width() // 2, border_rect.y + 2.5*FONT_MENUS.get_height()])
         surf.blit(kettle_label, [border_rect.width * (3/4) - kettle_label.get_width() // 2,
                                   border_rect.y + 2.5 * FONT_MENUS.get_height()])
-        # almost stupidest way to do this
-        # I had a stupider way
         tvs = [tea_varieties.BLACK, tea_varieties.GREEN, tea_varieties.HERBAL, tea_varieties.ENDGAME]
-        s_counts = []
-        for tv in tvs:
-            s_counts.append(len(list(filter(lambda i: i.variety==tv, self.satchel_contents))))
-        k_counts = []
-        for tv in tvs:
-            k_counts.append(len(list(filter(lambda i: i.variety==tv, self.kettle_contents))))
+        s_counts = [self.parent.player.inventory.count(TeaLeaf, tv) for tv in tvs]
+        k_counts = [0]*len(tvs)
+        for leaf in self.kettle.leaves: k_counts[leaf.variety] += 1
         labels = list("abcd") # I can hardcode the alphabet; not like it's gonna change, right
         for i in range(4):
             satchel_render = FONT_MENUS.render(f"{labels[i]} - {s_counts[i]}x {tea_varieties.names[tvs[i]]}", antialias_menu, [255, 255, 255] if self.tab==0 else [150, 150, 150])
@@ -679,34 +1330,34 @@ class BrewingWindow:
                 self.tab = [1, 0][self.tab]
         if ev.type == pygame.TEXTINPUT:
             if ev.text in list("abcd"):
-                container = [self.satchel_contents, self.kettle_contents][self.tab]
-                leaves = list(filter(lambda l: l.variety==list("abcd").index(ev.text),
-                                   container))
-                if leaves: leaf = leaves[0]
-                else: return
-
+                variety = list("abcd").index(ev.text)
+                satchel = self.parent.player.inventory
                 if self.tab == 0:
-                    if not kettle.leaves or (len(self.kettle.leaves) > 0 and self.kettle.leaves[0].variety == leaf.variety):
-                        self.parent.player.inventory.remove(leaf)
+                    leaf = satchel.first(TeaLeaf, variety)
+                    if not leaf: return
+                    if not self.kettle.leaves or self.kettle.leaves[0].variety == leaf.variety:
+                        satchel.remove(leaf)
                         self.kettle.leaves.append(leaf)
                 else:
+                    leaf = next((l for l in self.kettle.leaves if l.variety == variety), None)
+                    if not leaf: return
                     self.kettle.leaves.remove(leaf)
-                    self.parent.player.inventory.append(leaf)
-                self.satchel_contents = list(filter(lambda i: type(i) == TeaLeaf,
-                                                    self.parent.player.inventory))
-                self.kettle_contents = kettle.leaves
+                    satchel.add(leaf)
 
     def close(self):
-        self.kettle.timer = int(1.5*len(self.kettle.leaves))
+        self.kettle.start_brewing(int(1.5*len(self.kettle.leaves)))
         if self.kettle.timer: self.parent.add_message(f"Started a kettle of {tea_varieties.names[self.kettle.leaves[0].variety]} tea.")
         self.parent.clear_modal()
 
-class TeaDeckWindow:
+class TeaDeckWindow(CachedWindow):
     def __init__(self, parent:GameRoot, new_teas, rearrange=False):
         self.parent = parent
         self.new_teas = new_teas
         self.rearrange = rearrange
 
+    def state(self):
+        return tuple(self.parent.player.tea_deck), tuple(self.new_teas)
+
     def handle(self, ev):
         if ev.type == pygame.MOUSEBUTTONDOWN and ev.button == RCLICK:
             self.close()
@@ -716,7 +1367,7 @@ class TeaDeckWindow:
             if ev.key == pygame.K_TAB:
                 self.tab = [1, 0][self.tab]
 
-    def rendered(self):
+    def build(self):
         pl = self.parent.player
         surf, border_rect = get_subwindow_dimensions(0.8)
         y = border_rect.top + 1.5*FONT_MENUS.get_height()
@@ -734,46 +1385,113 @@ class TeaDeckWindow:
 
 
 
-lev = Level(LEVEL_W, LEVEL_H, 1)
-start = lev.generate(int((72*20)*0.3))
+def new_game(cols=LEVEL_W, rows=LEVEL_H):
+    lev = Level(cols, rows, 1)
+    start = lev.generate(int(cols*rows*FLOOR_FRACTION))
 
-player = Unit("questant", "Tom", 10, 10, 4, "@", *start, lev)
-mob =    Unit("goblin", "", 5, 5, 3, "g", player.x+1, player.y+1, lev, factions.CAVE)
+    player = Unit("questant", "Tom", 10, 10, 4, "@", *start, lev)
+    mob =    Unit("goblin", "", 5, 5, 3, "g", player.x+1, player.y+1, lev, factions.CAVE)
 
 
-tealeaf = TeaLeaf(tea_varieties.HERBAL)
-tealeaf2 = TeaLeaf(tea_varieties.BLACK)
-[player.inventory.append(tealeaf) for i in range(5)]
-player.inventory.append(tealeaf2)
+    # each leaf its own object; the satchel holds any one item only once
+    [player.add_item(TeaLeaf(tea_varieties.HERBAL)) for i in range(5)]
+    player.add_item(TeaLeaf(tea_varieties.BLACK))
 
-player.set_level(lev, [player.x, player.y])
-mob.set_level(lev, [player.x+1, player.y+1])
+    player.set_level(lev, [player.x, player.y])
+    mob.set_level(lev, [player.x+1, player.y+1])
 
-game = GameRoot(lev, player)
+    game = GameRoot(lev, player)
 
+    game.add_message("Welcome to TeaRL! '?' for help.")
 
+    ktile = lev.get_tile([player.x, max(player.y-1, 0)])
+    kettle = Kettle(game)
+    ktile.set_item(kettle)
+    game.set_kettle(kettle)
 
-game.add_message("Welcome to TeaRL! '?' for help.")
+    #kettle.activate()
+    return game
 
-ktile = lev.get_tile([player.x, player.y-1])
-kettle = Kettle(game)
-ktile.set_item(kettle)
-game.set_kettle(kettle)
 
-#kettle.activate()
-
-clock = pygame.time.Clock()
-
-
-while True:
-    for event in pygame.event.get():
-        game.handle(event)
-    screen.fill([0,0,0])
-    game.render(screen)
-
-    pygame.display.flip()
-    #player.move_to([player.x + 1, player.y])
-    clock.tick(60)
+def render_overlay(lines):
+    # the F3 timing readout
+    rendered = [FONT_MENUS.render(line, True, [255, 255, 0], [0, 0, 0]) for line in lines]
+    surf = pygame.Surface([max(r.get_width() for r in rendered), sum(r.get_height() for r in rendered)])
+    y = 0
+    for r in rendered:
+        surf.blit(r, [0, y])
+        y += r.get_height()
+    return surf
 
 
+def main():
+    global screen
+    import argparse, atexit
+    import savegame, replay # these import this module, so they can't come in at the top
+    parser = argparse.ArgumentParser(description="Tea Quest")
+    parser.add_argument("--seed", type=int, help="start a new game from this seed")
+    parser.add_argument("--record", help="start a new game and record it to this file, for replay.py")
+    parser.add_argument("--trace", help="time every frame and write a chrome://tracing file here on exit")
+    parser.add_argument("--size", help=f"start a new game in COLSxROWS caves ({LEVEL_W}x{LEVEL_H} if not given)")
+    args = parser.parse_args()
 
+    pygame.init()
+    load_fonts()
+    screen = pygame.display.set_mode([WIDTH, HEIGHT])
+    seed = args.seed if args.seed is not None else random.getrandbits(64)
+    seed_rngs(seed)
+    game, load_error = None, None
+    if os.path.exists(SAVE_PATH) and args.seed is None and not args.record and not args.size:
+        try:
+            game = savegame.load(SAVE_PATH)
+        except savegame.LOAD_ERRORS as e:
+            load_error = e
+        if game and not game.player.living:
+            game = None
+    if game is None:
+        game = new_game(*[int(n) for n in args.size.lower().split("x")]) if args.size else new_game()
+        if load_error:
+            # left where it is; the next F5 writes over it
+            game.add_message(f"Couldn't load the old save ({load_error}), so here's a new game.")
+    if args.record:
+        game.recorder = replay.Recorder(args.record, seed, [game.level.ncols, game.level.nrows])
+    if args.trace:
+        profiler.enabled = True
+        atexit.register(profiler.dump_trace, args.trace)
+    clock = pygame.time.Clock()
+    show_overlay, overlay, overlay_rect, frame = False, None, None, 0
+
+    while True:
+        frame_start = profiler.start()
+        for event in pygame.event.get():
+            if event.type == pygame.KEYDOWN and event.key == pygame.K_F3:
+                # the overlay isn't part of the game, so this stays out of recordings
+                show_overlay = not show_overlay
+                profiler.enabled = show_overlay or bool(args.trace)
+                continue
+            game.handle(event)
+        if overlay_rect:
+            # put back what the overlay covered; it gets drawn again on top if it's still up
+            game.dirty_cells |= game.cells_under(overlay_rect)
+            overlay_rect = None
+        dirty = game.render(screen)
+        if show_overlay:
+            if overlay is None or frame % 15 == 0:
+                overlay = render_overlay(profiler.report())
+            overlay_rect = screen.blit(overlay, overlay.get_rect(topright=[WIDTH, FONT_MENUS.get_height()]))
+            dirty.append(overlay_rect)
+        update_start = profiler.start()
+        if dirty:
+            pygame.display.update(dirty)
+        profiler.stop("display_update", update_start)
+        profiler.stop("frame", frame_start)
+        profiler.end_frame()
+        frame += 1
+        #player.move_to([player.x + 1, player.y])
+        clock.tick(60)
+
+
+if __name__ == "__main__":
+    # go through the importable module, so savegame and friends see the same classes as the running game
+    import main
+    main.main()
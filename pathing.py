@@ -0,0 +1,51 @@
+# same order as main.directions.deltas, so an index here is a move action there
+DELTAS = [[0, -1], [1, -1], [1, 0], [1, 1], [0, 1], [-1, 1], [-1, 0], [-1, -1]]
+
+
+def distance_field(passable, ncols, nrows, goal, max_dist):
+    """
+    Breadth-first (Dijkstra with every step costing 1) distance to goal over a flat
+    passable grid, moving 8-ways. Only cells within max_dist steps are filled in, so the
+    cost depends on max_dist rather than the map size.
+    Returns {index: steps} where index is y*ncols + x.
+    """
+    gx, gy = goal
+    size = ncols * nrows
+    # walk flat indices; only the x wrap-around needs checking separately
+    steps_xy = [(dx, dy * ncols + dx) for dx, dy in DELTAS]
+    start = gy * ncols + gx
+    field = {start: 0}
+    frontier = [start]
+    steps = 0
+    while frontier and steps < max_dist:
+        steps += 1
+        next_frontier = []
+        for i in frontier:
+            x = i % ncols
+            for dx, offset in steps_xy:
+                j = i + offset
+                if 0 <= j < size and 0 <= x + dx < ncols and passable[j] and j not in field:
+                    field[j] = steps
+                    next_frontier.append(j)
+        frontier = next_frontier
+    return field
+
+
+def downhill(field, ncols, nrows, pos, blocked=None):
+    """
+    Index into DELTAS of the neighbour of pos closest to the field's goal, skipping
+    any neighbour blocked(index) says is taken. None if pos is off the field or no
+    neighbour is any closer.
+    """
+    x, y = pos
+    best, best_dist = None, field.get(y * ncols + x)
+    if best_dist is None:
+        return None
+    for d, (dx, dy) in enumerate(DELTAS):
+        nx, ny = x + dx, y + dy
+        if 0 <= nx < ncols and 0 <= ny < nrows:
+            i = ny * ncols + nx
+            dist = field.get(i)
+            if dist is not None and dist < best_dist and not (blocked and blocked(i)):
+                best, best_dist = d, dist
+    return best
@@ -0,0 +1,76 @@
+import json, os, threading, time
+from collections import deque
+
+
+class Profiler:
+    """
+    Timings for the phases of a frame (handle, advance, level render, modal render, display update)
+    and counts of what got drawn, kept over the last few hundred frames. Off unless the overlay is up
+    or a trace is being recorded, and cheap to call either way.
+    """
+    def __init__(self, window=240, trace_length=200000):
+        self.enabled = False
+        self.window = window
+        self.samples = {} # phase -> rolling ns durations
+        self.counts = {} # counter -> rolling per-frame totals
+        self.frame_counts = {}
+        self.trace = deque(maxlen=trace_length) # (phase, start ns, duration ns, thread id) for dump_trace
+        self.origin = time.perf_counter_ns()
+
+    def start(self):
+        return time.perf_counter_ns() if self.enabled else 0
+
+    def stop(self, phase, start):
+        if not self.enabled or not start: return
+        end = time.perf_counter_ns()
+        samples = self.samples.get(phase)
+        if samples is None:
+            samples = self.samples[phase] = deque(maxlen=self.window)
+        samples.append(end - start)
+        self.trace.append((phase, start, end - start, threading.get_ident()))
+
+    def count(self, counter, n=1):
+        if self.enabled:
+            self.frame_counts[counter] = self.frame_counts.get(counter, 0) + n
+
+    def end_frame(self):
+        # per-frame counters go into their own rolling window, zero included
+        if not self.enabled: return
+        for counter in set(self.counts) | set(self.frame_counts):
+            if counter not in self.counts:
+                self.counts[counter] = deque(maxlen=self.window)
+            self.counts[counter].append(self.frame_counts.get(counter, 0))
+        self.frame_counts = {}
+
+    def percentiles(self, phase, ps=(50, 99)):
+        # over the rolling window, in ms. None if that phase hasn't run lately
+        samples = self.samples.get(phase)
+        if not samples: return None
+        ordered = sorted(samples)
+        return [ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))] / 1e6 for p in ps]
+
+    def mean_count(self, counter):
+        totals = self.counts.get(counter)
+        return sum(totals) / len(totals) if totals else 0
+
+    def report(self):
+        # lines for the overlay
+        lines = []
+        for label, phase in [("frame", "frame"), ("turn", "advance"), ("input", "handle"),
+                             ("map", "level_render"), ("modal", "modal_rendered"), ("flip", "display_update")]:
+            p = self.percentiles(phase)
+            if p: lines.append(f"{label:>6} p50 {p[0]:6.2f}ms  p99 {p[1]:6.2f}ms")
+        lines.append(f" blits {self.mean_count('blits'):6.1f}/frame  glyphs {self.mean_count('glyph_renders'):5.2f}/frame")
+        return lines
+
+    def dump_trace(self, path):
+        # chrome://tracing / perfetto "complete" events, timestamps in us from when the profiler was made
+        pid = os.getpid()
+        events = [{"name": phase, "ph": "X", "ts": (start - self.origin) / 1000, "dur": duration / 1000,
+                   "pid": pid, "tid": tid} for phase, start, duration, tid in self.trace]
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+# the one the game reports into
+profiler = Profiler()
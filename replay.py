@@ -0,0 +1,80 @@
+import argparse, json, time
+
+import pygame
+
+import main
+from main import new_game, seed_rngs, load_fonts
+
+# the events GameRoot and the modals actually look at, and the fields of each they read
+RECORDED_EVENTS = {"KEYDOWN": (pygame.KEYDOWN, ["key"]),
+                   "TEXTINPUT": (pygame.TEXTINPUT, ["text"]),
+                   "MOUSEBUTTONDOWN": (pygame.MOUSEBUTTONDOWN, ["button"]),
+                   "QUIT": (pygame.QUIT, [])}
+EVENT_NAMES = {event_type: name for name, (event_type, fields) in RECORDED_EVENTS.items()}
+
+
+class Recorder:
+    # writes the seed and cave size, then every event handed to GameRoot.handle, as one json object per line
+    def __init__(self, path, seed, size):
+        self.file = open(path, "w")
+        self.write({"seed": seed, "size": list(size)})
+
+    def write(self, obj):
+        self.file.write(json.dumps(obj) + "\n")
+        # quitting goes straight out through sys.exit, so don't sit on anything
+        self.file.flush()
+
+    def record(self, ev):
+        name = EVENT_NAMES.get(ev.type)
+        if name is None:
+            return
+        self.write({"type": name, **{field: getattr(ev, field) for field in RECORDED_EVENTS[name][1]}})
+
+
+def load_recording(path):
+    # seed, [cols, rows], events. recordings from before the size was written were all the default size
+    with open(path) as f:
+        header = json.loads(f.readline())
+        size = header.get("size", [main.LEVEL_W, main.LEVEL_H])
+        return header["seed"], size, [json.loads(line) for line in f if line.strip()]
+
+
+def replay(seed, events, size=None):
+    # reruns a recorded session as fast as the turn logic goes. nothing is drawn
+    seed_rngs(seed)
+    game = new_game(*size) if size else new_game()
+    game.save_path = None
+    for event in events:
+        if event["type"] == "QUIT":
+            break
+        event_type, fields = RECORDED_EVENTS[event["type"]]
+        game.handle(pygame.event.Event(event_type, {field: event[field] for field in fields}))
+    return game
+
+
+def show(game):
+    # the final frame, left up until the window is closed
+    pygame.init()
+    load_fonts()
+    main.screen = pygame.display.set_mode([main.WIDTH, main.HEIGHT])
+    game.render(main.screen)
+    pygame.display.flip()
+    while pygame.event.wait().type != pygame.QUIT:
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a session recorded with main.py --record.")
+    parser.add_argument("recording")
+    parser.add_argument("--show-last", action="store_true", help="open a window with the final frame")
+    args = parser.parse_args()
+
+    seed, size, events = load_recording(args.recording)
+    start = time.perf_counter()
+    game = replay(seed, events, size)
+    elapsed = time.perf_counter() - start
+    pl = game.player
+    print(f"{len(events)} events, {game.turns} turns in {elapsed:.3f}s; "
+          f"{pl.proper_name} at {pl.x},{pl.y} with {pl.hp}/{pl.maxhp}HP on cave layer {game.level.level_num}")
+    if args.show_last:
+        show(game)
@@ -0,0 +1,320 @@
+"""
+Binary save files for a GameRoot.
+
+Layout: MAGIC, a format version byte, then one zlib-compressed body. The body is
+little-endian struct fields, with strings and byte blobs prefixed by a u32 length.
+Terrain and the player's tile memory go in as the level's own flat byte arrays,
+not as per-tile records.
+"""
+import os, struct, zlib
+
+from main import Level, Unit, GameRoot, Inventory, Item, TeaLeaf, Tea, Kettle, TileMemory, LevelPregenerator, \
+    terrains, rngs, FLOOR_FRACTION
+from schedule import Timer
+
+MAGIC = b"TEARL"
+VERSION = 5
+STATS = ["damage_dealt", "damage_taken", "kills", "teas_brewed"]
+
+# what reading a save from an older build, or a cut-short or mangled file, can raise
+LOAD_ERRORS = (OSError, ValueError, IndexError, struct.error, zlib.error)
+
+# item type codes
+ITEM, TEA_LEAF, TEA, KETTLE = range(4)
+
+# terrain id -> passable, for rebuilding Level.passable with bytes.translate
+PASSABLE_TABLE = bytes(int(terrains.passable[t]) if t < len(terrains.passable) else 0 for t in range(256))
+
+
+class Writer:
+    def __init__(self):
+        self.buf = bytearray()
+
+    def pack(self, fmt, *values):
+        self.buf += struct.pack("<" + fmt, *values)
+
+    def blob(self, data):
+        self.pack("I", len(data))
+        self.buf += data
+
+    def string(self, text):
+        self.blob(text.encode("utf-8"))
+
+
+class Reader:
+    def __init__(self, data):
+        self.data = memoryview(data)
+        self.pos = 0
+
+    def unpack(self, fmt):
+        fmt = "<" + fmt
+        values = struct.unpack_from(fmt, self.data, self.pos)
+        self.pos += struct.calcsize(fmt)
+        return values
+
+    def one(self, fmt):
+        return self.unpack(fmt)[0]
+
+    def blob(self):
+        size = self.one("I")
+        data = bytes(self.data[self.pos:self.pos + size])
+        self.pos += size
+        return data
+
+    def string(self):
+        return self.blob().decode("utf-8")
+
+
+def write_item(w, item):
+    if type(item) == TeaLeaf:
+        w.pack("BB", TEA_LEAF, item.variety)
+    elif type(item) == Tea:
+        w.pack("BB", TEA, item.variety)
+    elif type(item) == Kettle:
+        # there's only ever the one kettle; its contents are saved with the game
+        w.pack("B", KETTLE)
+    else:
+        w.pack("B", ITEM)
+        w.string(item.name)
+        w.string(item.char)
+
+
+def read_item(r, game):
+    kind = r.one("B")
+    if kind == TEA_LEAF:
+        return TeaLeaf(r.one("B"))
+    if kind == TEA:
+        return Tea(r.one("B"))
+    if kind == KETTLE:
+        return game.active_kettle
+    return Item(r.string(), r.string())
+
+
+def write_timer(w, scheduler, actor):
+    # ticks until actor is due plus its place in the queue, or -1 if it isn't queued
+    entry = scheduler.entries.get(actor) if actor else None
+    if entry:
+        w.pack("qQ", entry[0] - scheduler.time, entry[1])
+    else:
+        w.pack("qQ", -1, 0)
+
+
+def write_unit_head(w, unit):
+    w.string(unit.creature_name)
+    w.string(unit.proper_name)
+    w.string(unit.char)
+    w.pack("iiiiiBBdiii", unit.hp, unit.maxhp, unit.max_damage, unit.x, unit.y, unit.faction, unit.living,
+           unit.energy_regen, unit.view_range, unit.max_inventory, unit.max_tea_deck)
+
+
+def write_unit_body(w, unit, scheduler):
+    # slots, holes included, so items keep their letters
+    w.pack("I", len(unit.inventory.slots))
+    for item in unit.inventory.slots:
+        w.pack("B", item is not None)
+        if item is not None:
+            write_item(w, item)
+    w.pack("I", len(unit.tea_deck))
+    for tea in unit.tea_deck:
+        write_item(w, tea)
+    w.pack("I", len(unit.effects))
+    for effect, timer in unit.effects.items():
+        w.pack("B", effect)
+        write_timer(w, scheduler, timer)
+    write_timer(w, scheduler, unit)
+
+
+def read_unit_head(r, level):
+    creature_name, proper_name, char = r.string(), r.string(), r.string()
+    hp, maxhp, max_damage, x, y, faction, living, energy_regen, view_range, max_inventory, max_tea_deck = \
+        r.unpack("iiiiiBBdiii")
+    unit = Unit(creature_name, proper_name, hp, maxhp, max_damage, char, x, y, level, faction, energy_regen)
+    unit.living = bool(living)
+    unit.view_range, unit.max_inventory, unit.max_tea_deck = view_range, max_inventory, max_tea_deck
+    if not unit.living:
+        # a dead player stays off the map, as die() left them, so they don't keep a monster out of their tile
+        level.remove_unit(unit)
+    return unit
+
+
+def read_unit_body(r, unit, game, pending):
+    unit.inventory = Inventory()
+    for slot in range(r.one("I")):
+        if r.one("B"):
+            unit.inventory.add(read_item(r, game), slot)
+    unit.tea_deck = [read_item(r, game) for i in range(r.one("I"))]
+    for i in range(r.one("I")):
+        effect = r.one("B")
+        ticks, order = r.unpack("qQ")
+        pending.append((order, lambda e=effect, t=ticks: unit.set_effect_timer(e, t)))
+    ticks, order = r.unpack("qQ")
+    pending.append((order, lambda t=ticks: game.scheduler.schedule(unit, t) if t >= 0
+                                           else game.scheduler.unschedule(unit)))
+
+
+def write_level_contents(w, level, player, scheduler):
+    # items as (index, item) pairs and monsters in turn order; almost every cell is empty
+    items = sorted(level.item_grid.items(), key=lambda entry: entry[0])
+    w.pack("I", len(items))
+    for i, item in items:
+        w.pack("I", i)
+        write_item(w, item)
+    monsters = [u for units in level.units.values() for u in units if u is not player]
+    w.pack("I", len(monsters))
+    for unit in monsters:
+        write_unit_head(w, unit)
+        write_unit_body(w, unit, scheduler)
+    return monsters
+
+
+def read_level_contents(r, level, game, pending):
+    for i in range(r.one("I")):
+        index = r.one("I")
+        level.get_tile([index % level.ncols, index // level.ncols]).set_item(read_item(r, game))
+    for i in range(r.one("I")):
+        read_unit_body(r, read_unit_head(r, level), game, pending)
+
+
+def read_terrain(r, level):
+    level.terrain = bytearray(r.blob())
+    level.passable = bytearray(level.terrain.translate(PASSABLE_TABLE))
+    level.terrain_version += 1
+
+
+def freeze_level(level, player, scheduler) -> bytes:
+    # a layer the player is leaving, packed down to compressed bytes for a LayerStore.
+    # time stops there until they come back, so timers are kept as ticks left
+    w = Writer()
+    w.pack("iiiii", level.ncols, level.nrows, level.level_num, player.x, player.y)
+    w.blob(bytes(level.terrain))
+    w.blob(bytes(player.memory.seen))
+    for unit in write_level_contents(w, level, player, scheduler):
+        # the level's own units come off the schedule when it stops being live; their effects have to go too
+        for timer in unit.effects.values():
+            scheduler.unschedule(timer)
+    return zlib.compress(bytes(w.buf))
+
+
+def thaw_level(data, game):
+    # back to (level, where the player left it, their memory of it, pending scheduler calls).
+    # the pending calls have to wait until the level is live, since they queue things on its scheduler
+    r = Reader(zlib.decompress(data))
+    ncols, nrows, level_num, x, y = r.unpack("iiiii")
+    level = Level(ncols, nrows, level_num)
+    read_terrain(r, level)
+    memory = TileMemory(ncols, nrows)
+    memory.seen = bytearray(r.blob())
+    pending = []
+    read_level_contents(r, level, game, pending)
+    return level, [x, y], memory, pending
+
+
+def dumps(game: GameRoot) -> bytes:
+    # written in the order loads() needs to rebuild things: the level, the player, the game root
+    # and kettle, then everything that can hold the kettle or be queued on the scheduler
+    level, player, scheduler, kettle = game.level, game.player, game.scheduler, game.active_kettle
+    w = Writer()
+    w.pack("qq", game.turns, scheduler.time)
+    w.pack("qqqq", *(game.stats[k] for k in STATS))
+
+    w.pack("iii", level.ncols, level.nrows, level.level_num)
+    w.blob(bytes(level.terrain))
+    write_unit_head(w, player)
+
+    w.pack("B", kettle is not None)
+    if kettle:
+        w.blob(bytes(leaf.variety for leaf in kettle.leaves))
+        w.blob(bytes(tea.variety for tea in kettle.teas))
+        write_timer(w, scheduler, kettle.brew_timer)
+
+    write_unit_body(w, player, scheduler)
+    w.blob(bytes(player.memory.seen))
+    write_level_contents(w, level, player, scheduler)
+    # layers visited earlier, already frozen
+    w.pack("I", len(game.visited))
+    for level_num in game.visited.level_nums():
+        w.pack("i", level_num)
+        w.blob(game.visited.peek(level_num))
+
+    for messages in [game.messages, game.message_log]:
+        w.pack("I", len(messages))
+        for message in messages:
+            w.string(message)
+
+    w.pack("BB", game.pregenerate, game.next_level is not None)
+    if game.next_level:
+        w.pack("Q", game.next_level.seed)
+
+    for name in sorted(rngs):
+        version, state, gauss_next = rngs[name].getstate()
+        w.pack("B625I", version, *state)
+        w.pack("?d", gauss_next is not None, gauss_next or 0.0)
+    return MAGIC + bytes([VERSION]) + zlib.compress(bytes(w.buf))
+
+
+def loads(data: bytes) -> GameRoot:
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("not a TeaRL save")
+    if data[len(MAGIC)] != VERSION:
+        raise ValueError(f"save format {data[len(MAGIC)]} isn't supported (expected {VERSION})")
+    r = Reader(zlib.decompress(data[len(MAGIC) + 1:]))
+    # everything on the scheduler gets queued at the end, in its original order, so ties break the same way
+    pending = []
+    turns, time = r.unpack("qq")
+    stats = dict(zip(STATS, r.unpack("qqqq")))
+
+    ncols, nrows, level_num = r.unpack("iii")
+    level = Level(ncols, nrows, level_num)
+    read_terrain(r, level)
+    player = read_unit_head(r, level)
+    game = GameRoot(level, player, pregenerate=False)
+    game.scheduler.time, game.turns = time, turns
+    game.stats.update(stats)
+
+    if r.one("B"):
+        kettle = Kettle(game)
+        game.set_kettle(kettle)
+        kettle.leaves = [TeaLeaf(v) for v in r.blob()]
+        kettle.teas = [Tea(v) for v in r.blob()]
+        ticks, order = r.unpack("qQ")
+        if ticks >= 0:
+            kettle.brew_timer = Timer(kettle.finish_brewing)
+            pending.append((order, lambda t=ticks: game.scheduler.schedule(kettle.brew_timer, t)))
+
+    read_unit_body(r, player, game, pending)
+    player.memory = TileMemory(ncols, nrows)
+    player.memory.seen = bytearray(r.blob())
+    read_level_contents(r, level, game, pending)
+    for i in range(r.one("I")):
+        game.visited.put(r.one("i"), r.blob())
+
+    game.messages.extend(r.string() for i in range(r.one("I")))
+    game.message_log.extend(r.string() for i in range(r.one("I")))
+    pregenerate, has_next = r.unpack("BB")
+    game.pregenerate = bool(pregenerate)
+    if has_next:
+        game.next_level = LevelPregenerator(ncols, nrows, level_num + 1, int(ncols*nrows*FLOOR_FRACTION),
+                                            seed=r.one("Q"))
+
+    for order, schedule in sorted(pending, key=lambda p: p[0]):
+        schedule()
+
+    for name in sorted(rngs):
+        version, *state = r.unpack("B625I")
+        has_gauss, gauss = r.unpack("?d")
+        rngs[name].setstate((version, tuple(state), gauss if has_gauss else None))
+    game.invalidate_all()
+    return game
+
+
+def save(game, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    # write then rename, so a crash mid-save can't eat the old save
+    with open(path + ".tmp", "wb") as f:
+        f.write(dumps(game))
+    os.replace(path + ".tmp", path)
+
+
+def load(path):
+    with open(path, "rb") as f:
+        return loads(f.read())
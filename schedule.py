@@ -0,0 +1,56 @@
+import heapq, itertools
+
+
+class Scheduler:
+    """
+    Min-heap of actors keyed on the game time of their next turn. Anything with a
+    take_turn() method can be queued; take_turn returns how long until it wants to
+    go again, or None to drop out of the queue.
+    """
+    def __init__(self):
+        self.time = 0
+        self.queue = []
+        self.entries = {}
+        self.counter = itertools.count() # breaks ties in the order things were queued
+
+    def schedule(self, actor, delay):
+        self.unschedule(actor)
+        entry = [self.time + delay, next(self.counter), actor]
+        self.entries[actor] = entry
+        heapq.heappush(self.queue, entry)
+
+    def unschedule(self, actor):
+        entry = self.entries.pop(actor, None)
+        if entry:
+            # left in the heap and skipped when it comes up; cheaper than re-heapifying
+            entry[2] = None
+
+    def next_turn(self, actor):
+        entry = self.entries.get(actor)
+        return entry[0] if entry else None
+
+    def run_until(self, time):
+        # lets everything due at or before time take its turn, in order
+        while self.queue and self.queue[0][0] <= time:
+            when, _, actor = heapq.heappop(self.queue)
+            if actor is None:
+                continue
+            del self.entries[actor]
+            self.time = when
+            delay = actor.take_turn()
+            if delay is not None and actor not in self.entries:
+                self.schedule(actor, delay)
+        self.time = time
+
+    def __contains__(self, actor):
+        return actor in self.entries
+
+
+class Timer:
+    # a one-shot scheduler entry: calls callback when it comes up, then drops out
+    def __init__(self, callback):
+        self.callback = callback
+
+    def take_turn(self):
+        self.callback()
+        return None